@@ -2,3 +2,4 @@ from .exceptions import *
 from .functiongenerator import FunctionGeneratorModulation, FunctionGeneratorWaveform
 from .oscilloscope import OscilloscopeRunMode, OscilloscopeSweepMode, OscilloscopeTriggerMode, OscilloscopeTimebaseMode, OscilloscopeCouplingMode
 from .powersupply import PowerSupplyLimit
+from .serialringbuffer import SerialRingBufferOverflowPolicy
@@ -0,0 +1,223 @@
+# Asyncio counterpart of the (binary) SerialRingBuffer
+#
+# AsyncSerialRingBuffer is used from a single event loop. The reading
+# side mirrors asyncio.StreamReader (read, readexactly, readuntil, EOF
+# handling) and push waits for free space (backpressure) instead of
+# dropping data. The storage is a SerialRingBuffer in single producer /
+# single consumer mode since everything happens in the loop thread.
+#
+# Producers running in other threads use push_threadsafe and
+# feed_eof_threadsafe - those schedule the operation on the event loop
+# and block the calling thread while the buffer is full.
+#
+# AsyncSerialRingBufferProtocol is an asyncio.Protocol feeding the
+# buffer from a transport (TCP connection, pipe, pyserial-asyncio, ...)
+# that pauses reading while the buffer is full.
+
+import asyncio
+import concurrent.futures
+
+from .exceptions import CommunicationError_BufferOverflow, CommunicationError_Timeout
+from .serialringbuffer import SerialRingBuffer
+
+class AsyncSerialRingBuffer:
+    def __init__(self, bufferSize = 4096, loop = None):
+        self._ring = SerialRingBuffer(bufferSize, binary = True, spsc = True)
+
+        if loop is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                loop = None
+        self._loop = loop
+
+        self._eof = False
+        self._readWaiters = [ ]
+        self._writeWaiters = [ ]
+
+        # Data received from a paused transport that did not fit
+        self._pending = bytearray()
+        self._transport = None
+        self._paused = False
+
+    def _getLoop(self):
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        return self._loop
+
+    async def _wait(self, waiters):
+        fut = self._getLoop().create_future()
+        waiters.append(fut)
+        try:
+            await fut
+        finally:
+            if fut in waiters:
+                waiters.remove(fut)
+
+    def _wake(self, waiters):
+        while len(waiters) > 0:
+            fut = waiters.pop()
+            if not fut.done():
+                fut.set_result(None)
+
+    def _store(self, data):
+        n = min(len(data), self._ring.remainingCapacity())
+        if n > 0:
+            self._ring.push(data[0:n])
+            self._wake(self._readWaiters)
+        return n
+
+    def _consumed(self):
+        if len(self._pending) > 0:
+            n = self._store(self._pending)
+            del self._pending[0:n]
+        if (len(self._pending) == 0) and self._paused and (self._transport is not None):
+            self._paused = False
+            self._transport.resume_reading()
+        self._wake(self._writeWaiters)
+
+    def _take(self, n):
+        data = self._ring.read(n)
+        self._consumed()
+        return data
+
+    # Transport side (used by AsyncSerialRingBufferProtocol)
+
+    def _set_transport(self, transport):
+        self._transport = transport
+
+    def _feed_transport_data(self, data):
+        data = memoryview(data).cast("B")
+        n = self._store(data)
+        if n < len(data):
+            self._pending.extend(data[n:])
+            if (not self._paused) and (self._transport is not None):
+                self._paused = True
+                self._transport.pause_reading()
+
+    # Public API
+
+    def available(self):
+        return self._ring.available() + len(self._pending)
+
+    def capacity(self):
+        return self._ring.capacity()
+
+    def at_eof(self):
+        return self._eof and (self.available() == 0)
+
+    def feed_eof(self):
+        self._eof = True
+        self._wake(self._readWaiters)
+        self._wake(self._writeWaiters)
+
+    def push_nowait(self, data):
+        if self._eof:
+            raise ValueError("Cannot push after EOF")
+        data = memoryview(data).cast("B")
+        if len(data) > self._ring.remainingCapacity():
+            raise CommunicationError_BufferOverflow(f"Cannot push {len(data)} bytes, only {self._ring.remainingCapacity()} bytes free")
+        self._store(data)
+
+    async def push(self, data):
+        data = memoryview(data).cast("B")
+        pos = 0
+        while pos < len(data):
+            if self._eof:
+                raise ValueError("Cannot push after EOF")
+            n = self._store(data[pos:])
+            pos = pos + n
+            if (n == 0) and (pos < len(data)):
+                await self._wait(self._writeWaiters)
+
+    async def read(self, n = -1):
+        if n == 0:
+            return b""
+        while (self._ring.available() == 0) and not self._eof:
+            await self._wait(self._readWaiters)
+
+        avail = self._ring.available()
+        if (n < 0) or (n > avail):
+            n = avail
+        return self._take(n)
+
+    async def readexactly(self, n):
+        if n < 0:
+            raise ValueError("Number of bytes has to be non negative")
+        res = bytearray()
+        while len(res) < n:
+            avail = self._ring.available()
+            if avail == 0:
+                if self._eof:
+                    raise asyncio.IncompleteReadError(bytes(res), n)
+                await self._wait(self._readWaiters)
+                continue
+            res.extend(self._take(min(avail, n - len(res))))
+        return bytes(res)
+
+    async def readuntil(self, separator = b"\n"):
+        separator = bytes(separator)
+        if len(separator) == 0:
+            raise ValueError("Separator must not be empty")
+
+        searched = 0
+        while True:
+            avail = self._ring.available()
+            idx = self._ring._find(separator, searched)
+            if idx >= 0:
+                return self._take(idx + len(separator))
+            searched = max(0, avail - len(separator) + 1)
+
+            if self._eof:
+                raise asyncio.IncompleteReadError(self._take(avail), None)
+            if self._ring.remainingCapacity() == 0:
+                raise asyncio.LimitOverrunError("Separator not found and buffer is full", avail)
+            await self._wait(self._readWaiters)
+
+    # Bridge for producers running in other threads
+
+    def _checkForeignThread(self):
+        if self._loop is None:
+            raise RuntimeError("Ring buffer is not bound to an event loop")
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            raise RuntimeError("Threadsafe methods must not be called from the event loop thread")
+
+    def push_threadsafe(self, data, timeout = None):
+        self._checkForeignThread()
+        data = bytes(data)
+        fut = asyncio.run_coroutine_threadsafe(self.push(data), self._loop)
+        try:
+            return fut.result(timeout)
+        except concurrent.futures.TimeoutError:
+            fut.cancel()
+            raise CommunicationError_Timeout("Timeout while waiting for free buffer space")
+
+    def feed_eof_threadsafe(self):
+        self._checkForeignThread()
+        self._loop.call_soon_threadsafe(self.feed_eof)
+
+class AsyncSerialRingBufferProtocol(asyncio.Protocol):
+    def __init__(self, ringBuffer):
+        if not isinstance(ringBuffer, AsyncSerialRingBuffer):
+            raise ValueError("Ring buffer has to be an AsyncSerialRingBuffer")
+        self._ringBuffer = ringBuffer
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self._ringBuffer._set_transport(transport)
+
+    def data_received(self, data):
+        self._ringBuffer._feed_transport_data(data)
+
+    def eof_received(self):
+        self._ringBuffer.feed_eof()
+        return False
+
+    def connection_lost(self, exc):
+        self._ringBuffer._set_transport(None)
+        self._ringBuffer.feed_eof()
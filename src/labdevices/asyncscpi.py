@@ -0,0 +1,165 @@
+import asyncio
+import numpy as np
+
+from .exceptions import CommunicationError_ConnectionLost, CommunicationError_ProtocolViolation, CommunicationError_Timeout, CommunicationError_NotConnected
+
+# Asyncio SCPI helper class
+#
+# Same surface as SCPIDeviceEthernet (connect, disconnect, isConnected,
+# scpiQuery, scpiCommand, scpiQueryBinary) but all I/O methods are
+# coroutines. Requests to a single device are serialized by a per device
+# lock so concurrent tasks never interleave their messages. On a timeout
+# the connection is closed since the position in the response stream
+# is unknown afterwards.
+#
+# scpiQueryMany sends the same query to many devices concurrently so
+# reading out a whole rack takes roughly the latency of a single device.
+
+class AsyncSCPIDeviceEthernet:
+    def __init__(self, address = None, port = 5025, timeout = None, readLimit = 2**24, logger = None):
+        if not isinstance(address, str) and not (address is None):
+            raise ValueError(f"Address {address} is invalid")
+        if not isinstance(port, int):
+            raise ValueError("Port has to be an integer value")
+        if (port <= 0) or (port > 65535):
+            raise ValueError("Port is out of range 1-65535")
+        if (timeout is not None) and (not isinstance(timeout, (int, float)) or (timeout <= 0)):
+            raise ValueError("Timeout has to be a positive number or None")
+
+        self._address = address
+        self._port = port
+        self._timeout = timeout
+        self._readLimit = readLimit
+
+        self._reader = None
+        self._writer = None
+        self._lock = None
+
+    def _getLock(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def _withTimeout(self, coro, timeout):
+        if timeout is None:
+            timeout = self._timeout
+        try:
+            return await asyncio.wait_for(coro, timeout)
+        except asyncio.TimeoutError:
+            await self._close()
+            raise CommunicationError_Timeout(f"Timeout while communicating with {self._address}:{self._port}")
+
+    async def _close(self):
+        if self._writer is not None:
+            writer = self._writer
+            self._reader = None
+            self._writer = None
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def connect(self, address = None, port = None, timeout = None):
+        if self._writer is None:
+            if address is not None:
+                if not isinstance(address, str):
+                    raise ValueError(f"Invalid address {address}")
+                self._address = address
+            if port is not None:
+                if not isinstance(port, int):
+                    raise ValueError("Port has to be an integer number")
+                if (port <= 0) or (port > 65535):
+                    raise ValueError("Port number is out of range 1-65535")
+                self._port = port
+
+            self._reader, self._writer = await self._withTimeout(
+                asyncio.open_connection(self._address, self._port, limit = self._readLimit),
+                timeout
+            )
+        return True
+
+    async def disconnect(self):
+        async with self._getLock():
+            await self._close()
+
+    def isConnected(self):
+        if self._writer is not None:
+            return True
+        else:
+            return False
+
+    async def _readLine(self):
+        try:
+            line = await self._reader.readuntil(b"\n")
+        except asyncio.IncompleteReadError:
+            await self._close()
+            raise CommunicationError_ConnectionLost("Connection closed by device")
+        return line
+
+    async def _query(self, query):
+        self._writer.write((query + "\n").encode())
+        await self._writer.drain()
+        return (await self._readLine()).decode("utf-8").strip()
+
+    async def _queryBinary(self, query, dt):
+        self._writer.write((query + "\n").encode())
+        await self._writer.drain()
+
+        try:
+            header = await self._reader.readexactly(2)
+            if header[0] != ord("#"):
+                raise CommunicationError_ProtocolViolation("Binary block does not start with #")
+            nDigits = header[1] - ord("0")
+            if (nDigits < 0) or (nDigits > 9):
+                raise CommunicationError_ProtocolViolation("Invalid binary block header")
+            if nDigits == 0:
+                data = (await self._readLine())[:-1]
+            else:
+                lengthField = await self._reader.readexactly(nDigits)
+                if not lengthField.isdigit():
+                    raise CommunicationError_ProtocolViolation(f"Invalid binary block length {lengthField}")
+                data = await self._reader.readexactly(int(lengthField))
+                await self._readLine()
+        except asyncio.IncompleteReadError:
+            await self._close()
+            raise CommunicationError_ConnectionLost("Connection closed by device")
+
+        if len(data) % dt.itemsize != 0:
+            raise CommunicationError_ProtocolViolation(f"Block length {len(data)} is not a multiple of {dt.itemsize}")
+        return np.frombuffer(data, dtype = dt)
+
+    async def scpiQuery(self, query, timeout = None):
+        async with self._getLock():
+            if not self.isConnected():
+                raise CommunicationError_NotConnected("Device not connected")
+            return await self._withTimeout(self._query(query), timeout)
+
+    async def scpiQueryBinary(self, query, dtype = np.uint8, byteorder = None, timeout = None):
+        dt = np.dtype(dtype)
+        if byteorder is not None:
+            if byteorder not in [ "<", ">", "=", "little", "big" ]:
+                raise ValueError(f"Unknown byte order {byteorder}")
+            dt = dt.newbyteorder(byteorder)
+
+        async with self._getLock():
+            if not self.isConnected():
+                raise CommunicationError_NotConnected("Device not connected")
+            return await self._withTimeout(self._queryBinary(query, dt), timeout)
+
+    async def scpiCommand(self, command, timeout = None):
+        async with self._getLock():
+            if not self.isConnected():
+                raise CommunicationError_NotConnected("Device not connected")
+            self._writer.write((command + "\n").encode())
+            await self._withTimeout(self._writer.drain(), timeout)
+        return
+
+async def scpiQueryMany(devices, query, timeout = None, return_exceptions = True):
+    # Returns the responses in the order of devices. With
+    # return_exceptions failing devices report their exception
+    # instead of aborting the whole readout
+    return await asyncio.gather(
+        *[ dev.scpiQuery(query, timeout = timeout) for dev in devices ],
+        return_exceptions = return_exceptions
+    )
@@ -8,4 +8,10 @@ class CommunicationError_Timeout(CommunicationError):
     pass
 
 class CommunicationError_NotConnected(CommunicationError):
-    pass
\ No newline at end of file
+    pass
+
+class CommunicationError_ConnectionLost(CommunicationError):
+    pass
+
+class CommunicationError_BufferOverflow(CommunicationError):
+    pass
@@ -2,11 +2,20 @@
 #
 # Base class for oscilloscopes
 
+import asyncio
 import atexit
+import numbers
+import queue
+import threading
+import time
 import numpy as np
 
+from collections.abc import MutableMapping
 from enum import Enum
 
+from .exceptions import CommunicationError_ProtocolViolation, CommunicationError_Timeout
+from . import waveformstats
+
 class OscilloscopeRunMode(Enum):
     RUN = 0,
     STOP = 1
@@ -48,6 +57,388 @@ class OscilloscopeCouplingMode(Enum):
     def has_value(cls, v):
         return v in cls._value2member_map_
 
+# Waveform container
+#
+# Holds all channels of a capture in one contiguous 2D array y of shape
+# (channels, points) sharing the time axis x. channels lists the
+# oscilloscope channel of every row, scale and offset carry the per
+# channel vertical settings (V/div and V) if known by the backend.
+#
+# The object also behaves like the dictionary returned by older
+# versions ("x", "y0", "y1", ... plus results of statistics like
+# "means"); rows returned for "y{n}" are views into y. Additional keys
+# are stored as is. toDict() returns a plain dictionary.
+#
+# Statistics are lazy, memoized properties (mean, std, rms, min, max,
+# ptp, percentiles, fft, rfft, ifft, autocorrelation, correlation).
+# They are calculated for all channels on first access and reused
+# afterwards. Requesting a statistic (requestStatistics, or the stats
+# argument of query_waveform) adds its entry to the dictionary view
+# (e.g. "means"), built on first access. Assigning new data through
+# the dictionary view drops all cached results; in place modification
+# of y is not detected.
+
+class OscilloscopeWaveform(MutableMapping):
+    # Statistic names accepted by requestStatistics and the key of
+    # their entry in the dictionary view
+    statisticsKeys = {
+        "mean" : "means",
+        "rms" : "rms",
+        "ptp" : "ptp",
+        "minmax" : "minmax",
+        "percentiles" : "percentiles",
+        "fft" : "fft",
+        "rfft" : "rfft",
+        "ifft" : "ifft",
+        "autocorrelate" : "autocorrelation",
+        "correlate" : "correlation"
+    }
+
+    # Scalar statistics calculated together since they share passes
+    # over the data
+    _scalarGroups = {
+        "mean" : ( "mean", "std" ),
+        "std" : ( "mean", "std" ),
+        "rms" : ( "rms", ),
+        "min" : ( "min", "max", "ptp" ),
+        "max" : ( "min", "max", "ptp" ),
+        "ptp" : ( "min", "max", "ptp" )
+    }
+
+    def __init__(self, y, x = None, channels = None, scale = None, offset = None):
+        y = np.asarray(y)
+        if y.ndim == 1:
+            y = y.reshape(( 1, len(y) ))
+        if y.ndim != 2:
+            raise ValueError("Waveform data has to be a 1D or 2D array")
+        if channels is None:
+            channels = list(range(y.shape[0]))
+        channels = [ int(ch) for ch in channels ]
+        if len(channels) != y.shape[0]:
+            raise ValueError(f"Got {len(channels)} channel numbers for {y.shape[0]} rows")
+        if len(set(channels)) != len(channels):
+            raise ValueError("Channel numbers have to be unique")
+        if (x is not None) and (len(x) != y.shape[1]):
+            raise ValueError(f"Time axis has {len(x)} points, waveform has {y.shape[1]}")
+        for meta in [ scale, offset ]:
+            if (meta is not None) and (len(meta) != len(channels)):
+                raise ValueError("Scale and offset have to be supplied for every channel")
+
+        self._y = y
+        self._x = x if x is None else np.asarray(x)
+        self._channels = channels
+        self._rows = { ch : i for i, ch in enumerate(channels) }
+        self._scale = None if scale is None else np.asarray(scale, dtype = np.float64)
+        self._offset = None if offset is None else np.asarray(offset, dtype = np.float64)
+        self._extra = { }
+        self._cache = { }
+        self._views = { }
+
+    @classmethod
+    def fromDict(cls, data, scale = None, offset = None):
+        # Builds a waveform from the dictionary layout returned by the
+        # backends ("x" and "y{n}"), all other keys are kept
+        if isinstance(data, OscilloscopeWaveform):
+            return data
+        channels = sorted([ int(key[1:]) for key in data if OscilloscopeWaveform._isChannelKey(key) ])
+        if len(channels) == 0:
+            raise ValueError("Waveform dictionary does not contain any channel")
+        rows = [ np.asarray(data[f"y{ch}"]) for ch in channels ]
+        if len(set([ len(row) for row in rows ])) != 1:
+            raise ValueError("All channels of a waveform have to have the same number of points")
+
+        wave = cls(np.stack(rows), x = data.get("x"), channels = channels, scale = scale, offset = offset)
+        for key, value in data.items():
+            if (key != "x") and not OscilloscopeWaveform._isChannelKey(key):
+                wave._extra[key] = value
+        return wave
+
+    @staticmethod
+    def _isChannelKey(key):
+        return isinstance(key, str) and (len(key) > 1) and (key[0] == "y") and key[1:].isdigit()
+
+    @property
+    def y(self):
+        return self._y
+
+    @property
+    def x(self):
+        return self._x
+
+    @property
+    def channels(self):
+        return list(self._channels)
+
+    @property
+    def scale(self):
+        return self._scale
+
+    @property
+    def offset(self):
+        return self._offset
+
+    @property
+    def nPoints(self):
+        return self._y.shape[1]
+
+    @property
+    def sampleInterval(self):
+        if (self._x is None) or (len(self._x) < 2):
+            return None
+        return float(self._x[1] - self._x[0])
+
+    def channel(self, channel):
+        if channel not in self._rows:
+            raise ValueError(f"Channel {channel} is not part of this waveform")
+        return self._y[self._rows[channel]]
+
+    def toDict(self):
+        return { key : self[key] for key in self }
+
+    # Lazy statistics
+
+    def _memo(self, name, compute):
+        if name not in self._cache:
+            self._cache[name] = compute()
+        return self._cache[name]
+
+    def _scalar(self, stat):
+        if stat not in self._cache:
+            group = OscilloscopeWaveform._scalarGroups[stat]
+            self._cache.update(waveformstats.computeStatistics(self._y, group))
+        return self._cache[stat]
+
+    def invalidateStatistics(self):
+        # Requested dictionary entries are rebuilt on next access
+        self._cache = { }
+        for key in self._views:
+            self._extra.pop(key, None)
+
+    @property
+    def mean(self):
+        return self._scalar("mean")
+
+    @property
+    def std(self):
+        return self._scalar("std")
+
+    @property
+    def rms(self):
+        return self._scalar("rms")
+
+    @property
+    def min(self):
+        return self._scalar("min")
+
+    @property
+    def max(self):
+        return self._scalar("max")
+
+    @property
+    def ptp(self):
+        return self._scalar("ptp")
+
+    def percentile(self, q):
+        # Returns an array of shape (channels, len(q))
+        q = tuple(np.atleast_1d(q).tolist())
+        return self._memo(( "percentiles", q ), lambda: waveformstats.computeStatistics(self._y, [ "percentiles" ], percentiles = q)["percentiles"])
+
+    @property
+    def percentiles(self):
+        return self.percentile(waveformstats.defaultPercentiles)
+
+    @property
+    def fft(self):
+        return self._memo("fft", lambda: np.fft.fft(self._y, axis = 1))
+
+    def _rfft(self):
+        return self._memo("rfft", lambda: waveformstats.rfftSpectrum(self._y, self.sampleInterval))
+
+    @property
+    def rfft(self):
+        return self._rfft()[1]
+
+    @property
+    def rfftFrequencies(self):
+        return self._rfft()[0]
+
+    @property
+    def ifft(self):
+        return self._memo("ifft", lambda: np.fft.ifft(self._y, axis = 1))
+
+    @property
+    def autocorrelation(self):
+        return self._memo("autocorrelation", lambda: waveformstats.autocorrelate(self._y))
+
+    @property
+    def correlation(self):
+        # Dictionary mapping channel pairs (ch1, ch2) with ch1 before ch2
+        # to np.correlate(y[ch1], y[ch2], mode = "full")
+        def compute():
+            result, pairs = waveformstats.correlatePairs(self._y)
+            return { ( self._channels[i], self._channels[j] ) : result[iPair] for iPair, ( i, j ) in enumerate(pairs) }
+        return self._memo("correlation", compute)
+
+    def requestStatistics(self, stat):
+        if stat not in OscilloscopeWaveform.statisticsKeys:
+            raise ValueError(f"Unknown statistics {stat}")
+        key = OscilloscopeWaveform.statisticsKeys[stat]
+        if (key not in self._extra) and (key not in self._views):
+            self._views[key] = stat
+
+    def _buildView(self, stat):
+        chans = self._channels
+        if stat == "mean":
+            view = { }
+            for iRow, ch in enumerate(chans):
+                view[f"y{ch}_avg"] = self.mean[iRow]
+                view[f"y{ch}_std"] = self.std[iRow]
+        elif stat == "minmax":
+            view = { }
+            for iRow, ch in enumerate(chans):
+                view[f"y{ch}_min"] = self.min[iRow]
+                view[f"y{ch}_max"] = self.max[iRow]
+        elif stat in [ "rms", "ptp", "ifft", "autocorrelate" ]:
+            values = {
+                "rms" : lambda: self.rms,
+                "ptp" : lambda: self.ptp,
+                "ifft" : lambda: self.ifft,
+                "autocorrelate" : lambda: self.autocorrelation
+            }[stat]()
+            view = { f"y{ch}" : values[iRow] for iRow, ch in enumerate(chans) }
+        elif stat == "percentiles":
+            view = { "q" : list(waveformstats.defaultPercentiles) }
+            for iRow, ch in enumerate(chans):
+                view[f"y{ch}"] = self.percentiles[iRow]
+        elif stat in [ "fft", "rfft" ]:
+            spectrum = self.fft if stat == "fft" else self.rfft
+            magnitude = self._memo(stat + "_real", lambda: np.absolute(spectrum))
+            view = { "frequency" : self.rfftFrequencies } if stat == "rfft" else { }
+            for iRow, ch in enumerate(chans):
+                view[f"y{ch}"] = spectrum[iRow]
+                view[f"y{ch}_real"] = magnitude[iRow]
+        else:
+            view = { f"y{ch1}y{ch2}" : value for ( ch1, ch2 ), value in self.correlation.items() }
+        return view
+
+    # Dictionary view
+
+    def __getitem__(self, key):
+        if key == "x":
+            if self._x is None:
+                raise KeyError(key)
+            return self._x
+        if OscilloscopeWaveform._isChannelKey(key) and (int(key[1:]) in self._rows):
+            return self._y[self._rows[int(key[1:])]]
+        if (key not in self._extra) and (key in self._views):
+            self._extra[key] = self._buildView(self._views[key])
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key == "x":
+            if len(value) != self.nPoints:
+                raise ValueError(f"Time axis has {len(value)} points, waveform has {self.nPoints}")
+            self._x = np.asarray(value)
+            self.invalidateStatistics()
+        elif OscilloscopeWaveform._isChannelKey(key) and (int(key[1:]) in self._rows):
+            self._y[self._rows[int(key[1:])]] = value
+            self.invalidateStatistics()
+        else:
+            self._views.pop(key, None)
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if (key == "x") or (OscilloscopeWaveform._isChannelKey(key) and (int(key[1:]) in self._rows)):
+            raise KeyError(f"{key} is part of the waveform data and cannot be removed")
+        if key in self._views:
+            del self._views[key]
+            self._extra.pop(key, None)
+            return
+        del self._extra[key]
+
+    def __iter__(self):
+        if self._x is not None:
+            yield "x"
+        for ch in self._channels:
+            yield f"y{ch}"
+        yield from list(self._extra.keys())
+        yield from [ key for key in self._views if key not in self._extra ]
+
+    def __len__(self):
+        pending = len([ key for key in self._views if key not in self._extra ])
+        return (0 if self._x is None else 1) + len(self._channels) + len(self._extra) + pending
+
+    def __repr__(self):
+        return f"OscilloscopeWaveform(channels = {self._channels}, points = {self.nPoints})"
+
+# Segmented acquisition result
+#
+# y has the shape (segments, channels, points), all segments share the
+# time axis x relative to their trigger. timestamps holds the trigger
+# time of every segment in seconds (relative to the first segment if
+# the device does not report absolute times). segment(i) returns a
+# single segment as OscilloscopeWaveform (a view, no copy).
+
+class OscilloscopeSegmentedWaveform:
+    def __init__(self, y, timestamps, x = None, channels = None, firstSegment = 0):
+        y = np.asarray(y)
+        if y.ndim != 3:
+            raise ValueError("Segmented waveform data has to be a 3D array (segments, channels, points)")
+        timestamps = np.asarray(timestamps, dtype = np.float64)
+        if timestamps.shape != ( y.shape[0], ):
+            raise ValueError(f"Got {len(timestamps)} timestamps for {y.shape[0]} segments")
+        if channels is None:
+            channels = list(range(y.shape[1]))
+        if len(channels) != y.shape[1]:
+            raise ValueError(f"Got {len(channels)} channel numbers for {y.shape[1]} channels")
+        if (x is not None) and (len(x) != y.shape[2]):
+            raise ValueError(f"Time axis has {len(x)} points, segments have {y.shape[2]}")
+
+        self._y = y
+        self._x = x if x is None else np.asarray(x)
+        self._timestamps = timestamps
+        self._channels = [ int(ch) for ch in channels ]
+        self._firstSegment = firstSegment
+
+    @property
+    def y(self):
+        return self._y
+
+    @property
+    def x(self):
+        return self._x
+
+    @property
+    def timestamps(self):
+        return self._timestamps
+
+    @property
+    def channels(self):
+        return list(self._channels)
+
+    @property
+    def firstSegment(self):
+        return self._firstSegment
+
+    @property
+    def nSegments(self):
+        return self._y.shape[0]
+
+    @property
+    def nPoints(self):
+        return self._y.shape[2]
+
+    def segment(self, index):
+        if (index < 0) or (index >= self.nSegments):
+            raise ValueError(f"Segment {index} is out of range [0;{self.nSegments-1}]")
+        return OscilloscopeWaveform(self._y[index], x = self._x, channels = self._channels)
+
+    def __len__(self):
+        return self.nSegments
+
+    def __repr__(self):
+        return f"OscilloscopeSegmentedWaveform(segments = {self.nSegments}, channels = {self._channels}, points = {self.nPoints})"
+
 class Oscilloscope:
     def __init__(
         self,
@@ -63,7 +454,10 @@ class Oscilloscope:
         triggerForceSupported = False,
 
         timebaseScale = ( None, None ),
-        voltageScale = ( None, None )
+        voltageScale = ( None, None ),
+
+        waveformChunkSize = 250000,
+        segmentedMemory = None
     ):
         if not isinstance(nChannels, int):
             raise ValueError("Channel count has to be an integer")
@@ -109,6 +503,14 @@ class Oscilloscope:
             raise ValueError("Voltage scale minimum has to be either float or integer")
         if not isinstance(voltageScale[1], float) and not isinstance(voltageScale[1], int):
             raise ValueError("Voltage scale minimum has to be either float or integer")
+        if not isinstance(waveformChunkSize, int) or (waveformChunkSize < 1):
+            raise ValueError("Waveform chunk size has to be a positive integer")
+        if segmentedMemory is not None:
+            if not (isinstance(segmentedMemory, tuple) or isinstance(segmentedMemory, list)) or (len(segmentedMemory) != 2):
+                raise ValueError("Segmented memory has to be None or a tuple of maximum segment count and maximum points per segment")
+            for limit in segmentedMemory:
+                if not isinstance(limit, int) or (limit < 1):
+                    raise ValueError("Segmented memory limits have to be positive integers")
 
         self._usesContext = False
         self._usedConnect = False
@@ -123,6 +525,10 @@ class Oscilloscope:
 
         self._timebase_scale = timebaseScale
         self._voltage_scale = voltageScale
+        self._waveform_chunk_size = waveformChunkSize
+        self._acquisition_poll_interval = 0.01
+        self._segmented_memory = segmentedMemory
+        self._segmented_config = None
 
         atexit.register(self._exitOff)
 
@@ -182,6 +588,41 @@ class Oscilloscope:
     def _query_waveform(self, channel, stats = None):
         raise NotImplementedError()
 
+    # Range downloads: _get_memory_depth returns the number of points
+    # in acquisition memory, _query_waveform_chunk returns the points
+    # [start, start + count) of a single channel as NumPy array
+    def _get_memory_depth(self):
+        raise NotImplementedError()
+    def _query_waveform_chunk(self, channel, start, count):
+        raise NotImplementedError()
+
+    # Segmented memory: segments and points per segment, None disables
+    # segmented acquisition. _query_segments returns a tuple (y,
+    # timestamps, x) with y of shape (count, channels, points)
+    def _set_segmented_acquisition(self, segments, points):
+        raise NotImplementedError()
+    def _get_segmented_acquisition(self):
+        raise NotImplementedError()
+    def _arm_segmented_acquisition(self):
+        raise NotImplementedError()
+    def _get_acquired_segments(self):
+        raise NotImplementedError()
+    def _query_segments(self, channels, start, count):
+        raise NotImplementedError()
+
+    def _wait_acquisition(self, timeout):
+        # Waits up to timeout seconds for a single acquisition to finish
+        # and returns True if it has. The default implementation polls
+        # the run mode until the device reports STOP; backends can use
+        # operation complete or status registers instead
+        deadline = time.monotonic() + timeout
+        while True:
+            if self._get_run_mode() == OscilloscopeRunMode.STOP:
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(min(self._acquisition_poll_interval, max(0, deadline - time.monotonic())))
+
     # Public API
 
     def set_channel_enable(self, channel, enabled):
@@ -313,75 +754,253 @@ class Oscilloscope:
             if (channel < 0) or (channel >= self._nchannels):
                 raise ValueError(f"Supplied channel {channel} is not valid")
 
+        if stats is not None:
+            if not isinstance(stats, list) and not isinstance(stats, tuple):
+                stats = [ stats ]
+            for stat in stats:
+                if stat not in OscilloscopeWaveform.statisticsKeys:
+                    raise ValueError(f"Unknown statistics {stat}")
+
         data = self._query_waveform(channel, stats)
+        if not isinstance(data, OscilloscopeWaveform):
+            data = OscilloscopeWaveform.fromDict(data)
 
         if stats is not None:
-            if isinstance(stats, list) or isinstance(stats, tuple):
-                for stat in stats:
-                    data = self._calculate_stats(data, stat)
-            else:
-                # Only single statistics requested
-                self._calculate_stats(data, stats)
+            for stat in stats:
+                data = self._calculate_stats(data, stat)
 
         return data
 
-    def _calculate_stats(self, data, stat):
-        availStats = {
-            "mean" : self._stats_avg,
-            "fft" : self._stats_fft,
-            "ifft" : self._stats_ifft,
-            "correlate" : self._stats_correlate,
-            "autocorrelate" : self._stats_autocorrelate
-        }
-
-        if stat in availStats:
-            data = availStats[stat](data)
-        return data
+    def acquire_stream(self, channel, count = None, stats = None, queueSize = 2, timeout = None):
+        # Generator yielding count captures (endless if None) acquired in
+        # SINGLE mode. A producer thread waits for the trigger, downloads
+        # the capture and arms the next trigger before handing the
+        # capture over through a queue of queueSize entries, so the
+        # device acquires while the consumer processes the previous
+        # capture. timeout limits the wait for every single trigger.
+        # The producer is started on the first iteration; closing (or
+        # garbage collecting) the generator stops it. Since the producer
+        # drives the device concurrently, the device must not be used
+        # by the consumer while the stream is open
+        self._check_stream_arguments(channel, count, stats, queueSize, timeout)
+        return self._acquisition_consumer(channel, count, stats, queueSize, timeout)
+
+    async def acquire_stream_async(self, channel, count = None, stats = None, queueSize = 2, timeout = None):
+        # Asynchronous iterator variant of acquire_stream, the blocking
+        # queue is waited on in the default executor
+        loop = asyncio.get_running_loop()
+        stream = self.acquire_stream(channel, count = count, stats = stats, queueSize = queueSize, timeout = timeout)
+        finished = object()
+        try:
+            while True:
+                data = await loop.run_in_executor(None, next, stream, finished)
+                if data is finished:
+                    break
+                yield data
+        finally:
+            await loop.run_in_executor(None, stream.close)
+
+    def _check_stream_arguments(self, channel, count, stats, queueSize, timeout):
+        if isinstance(channel, list) or isinstance(channel, tuple):
+            for ch in channel:
+                if (int(ch) < 0) or (int(ch) >= self._nchannels) or (int(ch) != ch):
+                    raise ValueError(f"Supplied channel {ch} is not valid")
+        elif (int(channel) < 0) or (int(channel) >= self._nchannels):
+            raise ValueError(f"Supplied channel {channel} is not valid")
+        if (count is not None) and (not isinstance(count, int) or (count < 1)):
+            raise ValueError("Capture count has to be a positive integer or None")
+        if not isinstance(queueSize, int) or (queueSize < 1):
+            raise ValueError("Queue size has to be a positive integer")
+        if (timeout is not None) and (not isinstance(timeout, (int, float)) or (timeout <= 0)):
+            raise ValueError("Timeout has to be a positive number or None")
+        if stats is not None:
+            for stat in (stats if isinstance(stats, (list, tuple)) else [ stats ]):
+                if stat not in OscilloscopeWaveform.statisticsKeys:
+                    raise ValueError(f"Unknown statistics {stat}")
+        if OscilloscopeRunMode.SINGLE not in self._supportedRunModes:
+            raise ValueError("Streaming acquisition requires SINGLE run mode support")
+
+    def _acquisition_producer(self, channel, count, stats, timeout, captures, stop):
+        def handOver(item):
+            while not stop.is_set():
+                try:
+                    captures.put(item, timeout = 0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            acquired = 0
+            self._set_run_mode(OscilloscopeRunMode.SINGLE)
+            while not stop.is_set():
+                deadline = None if timeout is None else time.monotonic() + timeout
+                while not self._wait_acquisition(0.1 if deadline is None else max(0, min(0.1, deadline - time.monotonic()))):
+                    if stop.is_set():
+                        return
+                    if (deadline is not None) and (time.monotonic() >= deadline):
+                        raise CommunicationError_Timeout(f"No trigger within {timeout} seconds")
+
+                data = self.query_waveform(channel, stats)
+                acquired = acquired + 1
+                last = (count is not None) and (acquired >= count)
+                if not last:
+                    self._set_run_mode(OscilloscopeRunMode.SINGLE)
+                if not handOver(( data, None )):
+                    return
+                if last:
+                    break
+            handOver(( None, None ))
+        except Exception as e:
+            handOver(( None, e ))
+
+    def _acquisition_consumer(self, channel, count, stats, queueSize, timeout):
+        captures = queue.Queue(maxsize = queueSize)
+        stop = threading.Event()
+        producer = threading.Thread(target = self._acquisition_producer, args = ( channel, count, stats, timeout, captures, stop ), daemon = True)
+        producer.start()
+        try:
+            while True:
+                data, error = captures.get()
+                if error is not None:
+                    raise error
+                if data is None:
+                    return
+                yield data
+        finally:
+            stop.set()
+            producer.join()
+
+    def _check_segmented_memory(self):
+        if self._segmented_memory is None:
+            raise ValueError("Segmented memory is not supported by this device")
+
+    def set_segmented_acquisition(self, segments, points):
+        self._check_segmented_memory()
+        if not isinstance(segments, int) or not isinstance(points, int):
+            raise ValueError("Segment count and points per segment have to be integers")
+        if (segments < 1) or (segments > self._segmented_memory[0]):
+            raise ValueError(f"Segment count {segments} is out of range [1;{self._segmented_memory[0]}]")
+        if (points < 1) or (points > self._segmented_memory[1]):
+            raise ValueError(f"Points per segment {points} is out of range [1;{self._segmented_memory[1]}]")
+
+        self._set_segmented_acquisition(segments, points)
+        self._segmented_config = ( segments, points )
+
+    def disable_segmented_acquisition(self):
+        self._check_segmented_memory()
+        self._set_segmented_acquisition(None, None)
+        self._segmented_config = None
+
+    def get_segmented_acquisition(self):
+        # Returns (segments, points) or None if disabled
+        self._check_segmented_memory()
+        self._segmented_config = self._get_segmented_acquisition()
+        return self._segmented_config
+
+    def arm_segmented_acquisition(self):
+        self._check_segmented_memory()
+        self._arm_segmented_acquisition()
+
+    def get_acquired_segments(self):
+        self._check_segmented_memory()
+        return self._get_acquired_segments()
+
+    def query_segments(self, channel, start = 0, count = None):
+        # Downloads count segments (all acquired if None) starting at
+        # segment start for one or more channels as
+        # OscilloscopeSegmentedWaveform of shape (segments, channels, points)
+        self._check_segmented_memory()
+        if isinstance(channel, list) or isinstance(channel, tuple):
+            channels = list(channel)
+        else:
+            channels = [ channel ]
+        for ch in channels:
+            if (int(ch) < 0) or (int(ch) >= self._nchannels) or (int(ch) != ch):
+                raise ValueError(f"Supplied channel {ch} is not valid")
+        channels = [ int(ch) for ch in channels ]
+        if len(set(channels)) != len(channels):
+            raise ValueError("Channels have to be unique")
+
+        if self._segmented_config is None:
+            self._segmented_config = self._get_segmented_acquisition()
+        if self._segmented_config is None:
+            raise ValueError("Segmented acquisition is not enabled")
+        if not isinstance(start, int) or (start < 0) or (start >= self._segmented_config[0]):
+            raise ValueError(f"Start segment {start} is out of range [0;{self._segmented_config[0]-1}]")
+        if count is None:
+            count = self._get_acquired_segments() - start
+        if not isinstance(count, int) or (count < 1) or (start + count > self._segmented_config[0]):
+            raise ValueError(f"Segment count {count} starting at {start} exceeds the {self._segmented_config[0]} configured segments")
+
+        y, timestamps, x = self._query_segments(channels, start, count)
+        return OscilloscopeSegmentedWaveform(y, timestamps, x = x, channels = channels, firstSegment = start)
+
+    def get_memory_depth(self):
+        return self._get_memory_depth()
+
+    def query_waveform_range(self, channel, start = 0, stop = None, chunkSize = None, progress = None, dtype = np.float64, out = None):
+        # Downloads the points [start, stop) of one channel (1D result)
+        # or a list of channels (2D result, one row per channel) in
+        # chunks of at most chunkSize points into a single preallocated
+        # array (or into out, e.g. an np.memmap). progress is called
+        # as progress(pointsDone, pointsTotal) after every chunk
+        if isinstance(channel, list) or isinstance(channel, tuple):
+            channels = list(channel)
+        else:
+            channels = [ channel ]
+        for ch in channels:
+            if (int(ch) < 0) or (int(ch) >= self._nchannels) or (int(ch) != ch):
+                raise ValueError(f"Supplied channel {ch} is not valid")
+        channels = [ int(ch) for ch in channels ]
+
+        if chunkSize is None:
+            chunkSize = self._waveform_chunk_size
+        if not isinstance(chunkSize, numbers.Integral) or (chunkSize < 1):
+            raise ValueError("Chunk size has to be a positive integer")
+        if (progress is not None) and not callable(progress):
+            raise ValueError("Progress callback has to be callable")
+
+        if not isinstance(start, numbers.Integral) or ((stop is not None) and not isinstance(stop, numbers.Integral)):
+            raise ValueError("Waveform range limits have to be integers")
+        # Backends frequently report the depth as NumPy integer
+        depth = int(self._get_memory_depth())
+        start = int(start)
+        stop = depth if stop is None else int(stop)
+        if (start < 0) or (stop <= start) or (stop > depth):
+            raise ValueError(f"Invalid waveform range {start} to {stop} for memory depth {depth}")
+        chunkSize = int(chunkSize)
+
+        nPoints = stop - start
+        shape = ( len(channels), nPoints ) if len(channels) > 1 else ( nPoints, )
+        if out is None:
+            out = np.empty(shape, dtype = dtype)
+        elif not isinstance(out, np.ndarray) or (out.shape != shape):
+            raise ValueError(f"Output has to be a NumPy array of shape {shape}")
+        rows = out.reshape(( len(channels), nPoints ))
+
+        total = nPoints * len(channels)
+        done = 0
+        for iRow, ch in enumerate(channels):
+            pos = 0
+            while pos < nPoints:
+                count = min(chunkSize, nPoints - pos)
+                chunk = self._query_waveform_chunk(ch, start + pos, count)
+                if (len(chunk) == 0) or (len(chunk) > count):
+                    raise CommunicationError_ProtocolViolation(f"Requested {count} points at {start + pos}, received {len(chunk)}")
+                # Devices may return fewer points than requested
+                rows[iRow, pos:pos + len(chunk)] = chunk
+                pos = pos + len(chunk)
+                done = done + len(chunk)
+                if progress is not None:
+                    progress(done, total)
+
+        return out
 
-    def _stats_avg(self, data):
-        # Do this for every channel in the data dictionary
-        for iChan in range(self._nchannels):
-            if f"y{iChan}" in data:
-                if "means" not in data:
-                    data["means"] = { }
-                if (f"y{iChan}_avg" not in data) or (f"y{iChan}_std" not in data):
-                    data["means"][f"y{iChan}_avg"] = np.mean(data[f"y{iChan}"])
-                    data["means"][f"y{iChan}_std"] = np.std(data[f"y{iChan}"])
-        return data
-    def _stats_fft(self, data):
-        for iChan in range(self._nchannels):
-            if f"y{iChan}" in data:
-                if "fft" not in data:
-                    data["fft"] = { }
-                if (f"y{iChan}" not in data["fft"]) or (f"y{iChan}_real" not in data["fft"]):
-                    data["fft"][f"y{iChan}"] = np.fft.fft(data[f"y{iChan}"])
-                    data["fft"][f"y{iChan}_real"] = np.absolute(data["fft"][f"y{iChan}"])
-        return data
-    def _stats_ifft(self, data):
-        for iChan in range(self._nchannels):
-            if f"y{iChan}" in data:
-                if "ifft" not in data:
-                    data["ifft"] = { }
-                if f"y{iChan}" not in data["ifft"]:
-                    data["ifft"][f"y{iChan}"] = np.fft.ifft(data[f"y{iChan}"])
-        return data
-    def _stats_autocorrelate(self, data):
-        for iChan in range(self._nchannels):
-            if f"y{iChan}" in data:
-                if "autocorrelation" not in data:
-                    data["autocorrelation"] = { }
-                if f"y{iChan}" not in data["autocorrelation"]:
-                    data["autocorrelation"][f"y{iChan}"] = np.correlate(data[f"y{iChan}"], data[f"y{iChan}"], mode = "full")
-        return data
-    def _stats_correlate(self, data):
-        if self._nchannels > 1:
-            for iChan1 in range(self._nchannels-1):
-                for iChan2 in range(iChan1+1, self._nchannels):
-                    if (f"y{iChan1}" in data) and (f"y{iChan2}" in data):
-                        if "correlation" not in data:
-                            data["correlation"] = { }
-                        if f"y{iChan1}y{iChan2}" not in data["correlation"]:
-                            data["correlation"][f"y{iChan1}y{iChan2}"] = np.correlate(data[f"y{iChan1}"], data[f"y{iChan2}"], mode = "full")
+    def _calculate_stats(self, data, stat):
+        # Statistics are evaluated lazily by the waveform on first
+        # access of the corresponding entry or property
+        data.requestStatistics(stat)
         return data
 
     def off(self):
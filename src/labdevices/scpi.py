@@ -1,21 +1,199 @@
+import os
 import socket
+import time
+import numpy as np
 
-from .exceptions import CommunicationError_Timeout, CommunicationError_NotConnected
+from .exceptions import CommunicationError, CommunicationError_ProtocolViolation, CommunicationError_Timeout, CommunicationError_NotConnected, CommunicationError_ConnectionLost
+from .scpimetrics import SCPITransportMetrics
+from .scpicache import SCPIQueryCache
 
 # SCPI helper class
 
+class SCPIBatchResult:
+    def __init__(self, query):
+        self._query = query
+        self._value = None
+        self._done = False
+
+    def _set(self, value):
+        self._value = value
+        self._done = True
+
+    @property
+    def query(self):
+        return self._query
+
+    @property
+    def done(self):
+        return self._done
+
+    @property
+    def value(self):
+        if not self._done:
+            raise ValueError(f"Batch containing {self._query} has not been executed yet")
+        return self._value
+
+class SCPIBatch:
+    # Collects commands and queries and executes them with a single
+    # round trip. By default all messages are pipelined in a single
+    # sendall and the responses are read back in order. With joined
+    # set the messages are joined into one program message separated
+    # by ";" (all headers have to be rooted, i.e. start with ":" or "*")
+    # and the single response is split at ";" again.
+    def __init__(self, device, joined = False):
+        self._device = device
+        self._joined = joined
+        self._messages = [ ]
+        self._results = [ ]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+
+    def command(self, command):
+        self._messages.append(command)
+        return self
+
+    def query(self, query):
+        res = SCPIBatchResult(query)
+        self._messages.append(query)
+        self._results.append(res)
+        return res
+
+    def execute(self):
+        if len(self._messages) == 0:
+            return [ ]
+
+        messages = self._messages
+        results = self._results
+        self._messages = [ ]
+        self._results = [ ]
+
+        if self._joined:
+            responses = self._device._scpiExecuteJoined(messages, len(results))
+        else:
+            responses = self._device._scpiExecutePipelined(messages, len(results))
+        for res, value in zip(results, responses):
+            res._set(value)
+        return responses
+
 class SCPIDeviceEthernet:
-    def __init__(self, address = None, port = 5025, logger = None):
+    # timeout applies to every send and receive, connectTimeout to
+    # establishing the connection (both in seconds, None blocks forever)
+    # and raise CommunicationError_Timeout. noDelay disables Nagle's
+    # algorithm so short queries are not delayed. keepAlive enables TCP
+    # keepalive probes after keepAliveIdle seconds of inactivity every
+    # keepAliveInterval seconds, dropping the connection after
+    # keepAliveCount unanswered probes (where supported by the platform)
+    #
+    # With reconnectAttempts > 0 a lost connection (broken pipe, reset or
+    # closed by the device) is re-established with up to reconnectAttempts
+    # attempts, waiting reconnectBackoff seconds after the first failed
+    # attempt and doubling the delay up to reconnectBackoffMax. The
+    # initCommands are replayed after each reconnect and the failed
+    # operation is retried once. Timeouts never trigger a reconnect.
+    #
+    # On a timeout the connection is dropped since the position in the
+    # response stream is unknown afterwards (a late reply would otherwise
+    # be returned as answer to the next query). Further operations raise
+    # CommunicationError_NotConnected until connect is called again or,
+    # with reconnectAttempts > 0, reconnect automatically.
+    #
+    # An SCPITransportMetrics instance passed as metrics (or set with
+    # setMetrics) receives timing and size information of every operation.
+    #
+    # An SCPIQueryCache passed as cache (or set with setCache) answers
+    # repeated idempotent queries without a round trip; commands sent
+    # through this transport invalidate the matching cached queries.
+    def __init__(
+        self,
+        address = None,
+        port = 5025,
+        logger = None,
+
+        timeout = None,
+        connectTimeout = None,
+        noDelay = True,
+        keepAlive = False,
+        keepAliveIdle = 60,
+        keepAliveInterval = 10,
+        keepAliveCount = 5,
+
+        reconnectAttempts = 0,
+        reconnectBackoff = 0.1,
+        reconnectBackoffMax = 5.0,
+        initCommands = None,
+
+        metrics = None,
+        cache = None
+    ):
         if not isinstance(address, str) and not (address is None):
             raise ValueError(f"Address {address} is invalid")
         if not isinstance(port, int):
             raise ValueError("Port has to be an integer value")
         if (port <= 0) or (port > 65535):
             raise ValueError("Port is out of range 1-65535")
+        if (timeout is not None) and (not isinstance(timeout, (int, float)) or (timeout <= 0)):
+            raise ValueError("Timeout has to be a positive number or None")
+        if (connectTimeout is not None) and (not isinstance(connectTimeout, (int, float)) or (connectTimeout <= 0)):
+            raise ValueError("Connect timeout has to be a positive number or None")
+        if not isinstance(noDelay, bool) or not isinstance(keepAlive, bool):
+            raise ValueError("No delay and keepalive flags have to be boolean")
+        for ka in [ keepAliveIdle, keepAliveInterval, keepAliveCount ]:
+            if not isinstance(ka, int) or (ka < 1):
+                raise ValueError("Keepalive idle time, interval and count have to be positive integers")
+        if not isinstance(reconnectAttempts, int) or (reconnectAttempts < 0):
+            raise ValueError("Reconnect attempts have to be a non negative integer")
+        if not isinstance(reconnectBackoff, (int, float)) or not isinstance(reconnectBackoffMax, (int, float)) or (reconnectBackoff < 0) or (reconnectBackoffMax < reconnectBackoff):
+            raise ValueError("Reconnect backoff has to be non negative and must not exceed the maximum backoff")
+        if (metrics is not None) and not isinstance(metrics, SCPITransportMetrics):
+            raise ValueError("Metrics have to be an SCPITransportMetrics instance or None")
+        if (cache is not None) and not isinstance(cache, SCPIQueryCache):
+            raise ValueError("Cache has to be an SCPIQueryCache instance or None")
+        if initCommands is None:
+            initCommands = [ ]
+        if not isinstance(initCommands, (list, tuple)):
+            raise ValueError("Initialization commands have to be supplied as list or tuple")
+        for cmd in initCommands:
+            if not isinstance(cmd, str):
+                raise ValueError(f"Initialization command {cmd} is not a string")
 
         self._address = address
         self._port = port
         self._socket = None
+        self._connectionDropped = False
+
+        self._timeout = timeout
+        self._connectTimeout = connectTimeout
+        self._noDelay = noDelay
+        self._keepAlive = keepAlive
+        self._keepAliveIdle = keepAliveIdle
+        self._keepAliveInterval = keepAliveInterval
+        self._keepAliveCount = keepAliveCount
+
+        self._reconnectAttempts = reconnectAttempts
+        self._reconnectBackoff = reconnectBackoff
+        self._reconnectBackoffMax = reconnectBackoffMax
+        self._initCommands = list(initCommands)
+        self._reconnects = 0
+
+        self._metrics = metrics
+        self._mBytesOut = 0
+        self._mBytesIn = 0
+        self._mSent = None
+        self._mFirstByte = None
+
+        self._cache = cache
+
+        # Received data is accumulated in a persistent buffer, bytes
+        # following the terminator of a response are kept for the next
+        # query. recv_into always uses the same chunk buffer
+        self._rxBuffer = bytearray()
+        self._rxChunk = bytearray(4096*10)
+        self._rxChunkView = memoryview(self._rxChunk)
 
     def connect(self, address = None, port = None):
         if self._socket is None:
@@ -30,15 +208,163 @@ class SCPIDeviceEthernet:
                     raise ValueError("Port number is out of range 1-65535")
                 self._port = port
 
-            self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self._socket.connect((self._address, self._port))
+            try:
+                sock = socket.create_connection((self._address, self._port), timeout = self._connectTimeout)
+            except socket.timeout:
+                raise CommunicationError_Timeout(f"Timeout while connecting to {self._address}:{self._port}")
+            sock.settimeout(self._timeout)
+            self._configureSocket(sock)
+
+            self._socket = sock
+            self._connectionDropped = False
+            self._rxBuffer.clear()
+            if self._cache is not None:
+                # The device may have been reset while disconnected
+                self._cache.clear()
         return True
 
+    def _configureSocket(self, sock):
+        if self._noDelay:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self._keepAlive:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, "TCP_KEEPIDLE"):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, self._keepAliveIdle)
+            elif hasattr(socket, "TCP_KEEPALIVE"):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, self._keepAliveIdle)
+            if hasattr(socket, "TCP_KEEPINTVL"):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, self._keepAliveInterval)
+            if hasattr(socket, "TCP_KEEPCNT"):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, self._keepAliveCount)
+
+    def _send(self, data):
+        try:
+            self._socket.sendall(data)
+        except socket.timeout:
+            self._dropConnection()
+            raise CommunicationError_Timeout(f"Timeout while sending to {self._address}:{self._port}")
+        if self._metrics is not None:
+            self._mBytesOut = self._mBytesOut + len(data)
+            self._mSent = time.perf_counter()
+
+    def _recvInto(self, view):
+        try:
+            n = self._socket.recv_into(view)
+        except socket.timeout:
+            self._dropConnection()
+            raise CommunicationError_Timeout(f"Timeout while waiting for data from {self._address}:{self._port}")
+        if n == 0:
+            raise CommunicationError_ConnectionLost("Connection closed by device")
+        if self._metrics is not None:
+            if self._mFirstByte is None:
+                self._mFirstByte = time.perf_counter()
+            self._mBytesIn = self._mBytesIn + n
+        return n
+
     def disconnect(self):
         if self._socket is not None:
             self._socket.shutdown(socket.SHUT_RDWR)
             self._socket.close()
             self._socket = None
+            self._rxBuffer.clear()
+        self._connectionDropped = False
+
+    def _dropConnection(self):
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            except OSError:
+                pass
+            self._socket = None
+            self._connectionDropped = True
+            self._rxBuffer.clear()
+
+    def _ensureConnected(self):
+        # Connections dropped after a timeout or error are re-established
+        # on the next operation if reconnecting is enabled
+        if not self.isConnected():
+            if (self._reconnectAttempts == 0) or not self._connectionDropped:
+                raise CommunicationError_NotConnected("Device not connected")
+            self._reconnect()
+
+    def _reconnect(self):
+        self._dropConnection()
+        delay = self._reconnectBackoff
+        lastError = None
+        for attempt in range(self._reconnectAttempts):
+            if attempt > 0:
+                time.sleep(delay)
+                delay = min(delay * 2, self._reconnectBackoffMax)
+            try:
+                self.connect()
+                for cmd in self._initCommands:
+                    self._send((cmd + "\n").encode())
+                self._reconnects = self._reconnects + 1
+                return
+            except (OSError, CommunicationError) as e:
+                lastError = e
+                self._dropConnection()
+        raise CommunicationError_NotConnected(f"Reconnecting to {self._address}:{self._port} failed after {self._reconnectAttempts} attempts: {lastError}")
+
+    def _transact(self, operation, *args):
+        self._ensureConnected()
+        if self._metrics is not None:
+            return self._measure(operation, args)
+        return self._execute(operation, args)
+
+    def _execute(self, operation, args):
+        if self._reconnectAttempts == 0:
+            return operation(*args)
+        try:
+            return operation(*args)
+        except (ConnectionError, CommunicationError_ConnectionLost):
+            self._reconnect()
+            return operation(*args)
+
+    def _measure(self, operation, args):
+        if isinstance(args[0], str):
+            mnemonic = (args[0].split(None, 1) + [ "" ])[0].upper()
+            isQuery = mnemonic.endswith("?")
+        else:
+            mnemonic = "BATCH"
+            isQuery = args[1] > 0
+
+        self._mBytesOut = 0
+        self._mBytesIn = 0
+        self._mSent = None
+        self._mFirstByte = None
+        error = None
+        start = time.perf_counter()
+        try:
+            return self._execute(operation, args)
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            end = time.perf_counter()
+            sent = self._mSent if self._mSent is not None else end
+            firstByte = self._mFirstByte if self._mFirstByte is not None else sent
+            firstByte = max(firstByte, sent)
+            self._metrics.record(mnemonic, isQuery, self._mBytesOut, self._mBytesIn, sent - start, firstByte - sent, end - firstByte, error)
+
+    def setMetrics(self, metrics):
+        if (metrics is not None) and not isinstance(metrics, SCPITransportMetrics):
+            raise ValueError("Metrics have to be an SCPITransportMetrics instance or None")
+        self._metrics = metrics
+
+    def getMetrics(self):
+        return self._metrics
+
+    def setCache(self, cache):
+        if (cache is not None) and not isinstance(cache, SCPIQueryCache):
+            raise ValueError("Cache has to be an SCPIQueryCache instance or None")
+        self._cache = cache
+
+    def getCache(self):
+        return self._cache
+
+    def reconnectCount(self):
+        return self._reconnects
 
     def isConnected(self):
         if self._socket is not None:
@@ -47,22 +373,264 @@ class SCPIDeviceEthernet:
             return False
 
     def scpiQuery(self, query):
-        if not self.isConnected():
-            raise CommunicationError_NotConnected("Device not connected")
-        self._socket.sendall((query + "\n").encode())
-        readData = ""
+        if self._cache is None:
+            return self._transact(self._scpiQuery, query)
+
+        # Joined messages ("VOLT 11;VOLT?", "*RST;*OPC?") may contain
+        # commands that invalidate cached queries and are never cached
+        self._cache.invalidate(query)
+        if ";" in query:
+            return self._transact(self._scpiQuery, query)
+
+        hit, value = self._cache.lookup(query)
+        if hit:
+            return value
+        value = self._transact(self._scpiQuery, query)
+        self._cache.store(query, value)
+        return value
+
+    def _scpiQuery(self, query):
+        self._send((query + "\n").encode())
+        return self._readLine().decode("utf-8").strip()
 
+    def _recvChunk(self):
+        n = self._recvInto(self._rxChunk)
+        self._rxBuffer += self._rxChunkView[0:n]
+        return n
+
+    def _readLine(self, terminator = b"\n"):
+        # Only newly received data is searched for the terminator
+        searched = 0
         while True:
-            dataBlock = self._socket.recv(4096*10)
-            dataBlockStr = dataBlock.decode("utf-8")
-            readData = readData + dataBlockStr
-            if dataBlockStr[-1] == '\n':
-                break
+            idx = self._rxBuffer.find(terminator, searched)
+            if idx >= 0:
+                line = self._rxBuffer[0:idx]
+                del self._rxBuffer[0:idx + len(terminator)]
+                return line
+            searched = max(0, len(self._rxBuffer) - len(terminator) + 1)
+            self._recvChunk()
+
+    def _binaryDtype(self, dtype, byteorder):
+        dt = np.dtype(dtype)
+        if byteorder is not None:
+            if byteorder not in [ "<", ">", "=", "little", "big" ]:
+                raise ValueError(f"Unknown byte order {byteorder}")
+            dt = dt.newbyteorder(byteorder)
+        return dt
+
+    def scpiQueryBinary(self, query, dtype = np.uint8, byteorder = None):
+        # Queries an IEEE 488.2 binary block (#<n><length><data>) and
+        # returns the data as NumPy array of the given dtype. byteorder
+        # ("<", ">" or "=") overrides the byte order of dtype
+        dt = self._binaryDtype(dtype, byteorder)
+        return self._transact(self._scpiQueryBinary, query, dt)
+
+    def _scpiQueryBinary(self, query, dt):
+        try:
+            self._send((query + "\n").encode())
+
+            length = self._readBlockHeader()
+            if length is None:
+                # Indefinite length block is terminated by the newline
+                data = self._readLine()
+                if len(data) % dt.itemsize != 0:
+                    raise CommunicationError_ProtocolViolation(f"Block length {len(data)} is not a multiple of {dt.itemsize}")
+                return np.frombuffer(bytes(data), dtype = dt)
+
+            raw = np.empty(length, dtype = np.uint8)
+            self._readExactlyInto(memoryview(raw))
+            self._readLine()
+
+            if length % dt.itemsize != 0:
+                raise CommunicationError_ProtocolViolation(f"Block length {length} is not a multiple of {dt.itemsize}")
+            return raw.view(dt)
+        except (OSError, CommunicationError):
+            # Drop the connection so a partially received response
+            # (e.g. an error message instead of a block) cannot leak
+            # into the next query
+            self._dropConnection()
+            raise
+
+    def _readBlockHeader(self):
+        # Returns the length of a definite length block or None for
+        # an indefinite length block (#0)
+        while len(self._rxBuffer) < 2:
+            self._recvChunk()
+        if self._rxBuffer[0] != ord("#"):
+            raise CommunicationError_ProtocolViolation("Binary block does not start with #")
+        nDigits = self._rxBuffer[1] - ord("0")
+        if (nDigits < 0) or (nDigits > 9):
+            raise CommunicationError_ProtocolViolation("Invalid binary block header")
+        if nDigits == 0:
+            del self._rxBuffer[0:2]
+            return None
+
+        while len(self._rxBuffer) < 2 + nDigits:
+            self._recvChunk()
+        lengthField = bytes(self._rxBuffer[2:2 + nDigits])
+        if not lengthField.isdigit():
+            raise CommunicationError_ProtocolViolation(f"Invalid binary block length {lengthField}")
+        del self._rxBuffer[0:2 + nDigits]
+        return int(lengthField)
 
-        return readData.strip()
+    def _readExactlyInto(self, view):
+        # Fills view from already buffered data first, then receives
+        # the remaining bytes directly into the target
+        n = min(len(self._rxBuffer), len(view))
+        view[0:n] = self._rxBuffer[0:n]
+        del self._rxBuffer[0:n]
+
+        pos = n
+        while pos < len(view):
+            pos = pos + self._recvInto(view[pos:])
+
+    def _skipBytes(self, n):
+        skip = min(len(self._rxBuffer), n)
+        del self._rxBuffer[0:skip]
+        n = n - skip
+        while n > 0:
+            n = n - self._recvInto(self._rxChunkView[0:min(n, len(self._rxChunk))])
+
+    def scpiQueryBinaryStream(self, query, chunkSize = 1048576, dtype = np.uint8, byteorder = None):
+        # Returns a generator yielding the binary block response in
+        # NumPy arrays of at most chunkSize bytes while data arrives so
+        # memory usage is bounded by the chunk size instead of the
+        # block size. If the generator is closed early the rest of the
+        # block is skipped, on errors the connection is dropped.
+        # Indefinite length blocks (#0) have to be received completely
+        # before the end is known and are only split afterwards
+        dt = self._binaryDtype(dtype, byteorder)
+        if not isinstance(chunkSize, int) or (chunkSize < 1) or (chunkSize % dt.itemsize != 0):
+            raise ValueError(f"Chunk size has to be a positive multiple of {dt.itemsize}")
+        self._ensureConnected()
+        return self._streamBlock(query, chunkSize, dt)
+
+    def _streamBlock(self, query, chunkSize, dt):
+        remaining = 0
+        pendingTerminator = False
+        try:
+            self._send((query + "\n").encode())
+            length = self._readBlockHeader()
+            if length is None:
+                data = self._readLine()
+                if len(data) % dt.itemsize != 0:
+                    raise CommunicationError_ProtocolViolation(f"Block length {len(data)} is not a multiple of {dt.itemsize}")
+                for pos in range(0, len(data), chunkSize):
+                    yield np.frombuffer(bytes(data[pos:pos + chunkSize]), dtype = dt)
+                return
+
+            remaining = length
+            pendingTerminator = True
+            if length % dt.itemsize != 0:
+                raise CommunicationError_ProtocolViolation(f"Block length {length} is not a multiple of {dt.itemsize}")
+            while remaining > 0:
+                chunk = np.empty(min(chunkSize, remaining), dtype = np.uint8)
+                self._readExactlyInto(memoryview(chunk))
+                remaining = remaining - len(chunk)
+                if remaining == 0:
+                    self._readLine()
+                    pendingTerminator = False
+                yield chunk.view(dt)
+            if pendingTerminator:
+                self._readLine()
+        except GeneratorExit:
+            if (remaining > 0) or pendingTerminator:
+                try:
+                    self._skipBytes(remaining)
+                    self._readLine()
+                except (OSError, CommunicationError):
+                    self._dropConnection()
+            raise
+        except (OSError, CommunicationError):
+            self._dropConnection()
+            raise
+
+    def scpiQueryBinaryInto(self, query, target, chunkSize = 1048576):
+        # Receives a binary block directly into target without holding
+        # the whole block in memory and returns the number of bytes
+        # received. target can be a writable C contiguous NumPy array
+        # (e.g. np.memmap) that is filled from the start (data is
+        # received directly into its memory), a file name or a binary
+        # file object the block is written to in chunks of chunkSize
+        if isinstance(target, np.ndarray):
+            if not target.flags['C_CONTIGUOUS'] or not target.flags['WRITEABLE']:
+                raise ValueError("Target array has to be writable and C contiguous")
+            return self._transact(self._scpiQueryBinaryArray, query, target)
+
+        if isinstance(target, (str, os.PathLike)):
+            with open(target, "wb") as f:
+                return self.scpiQueryBinaryInto(query, f, chunkSize)
+
+        if not hasattr(target, "write"):
+            raise ValueError("Target has to be a NumPy array, a file name or a writable file object")
+        written = 0
+        for chunk in self.scpiQueryBinaryStream(query, chunkSize = chunkSize):
+            target.write(chunk)
+            written = written + len(chunk)
+        return written
+
+    def _scpiQueryBinaryArray(self, query, target):
+        try:
+            self._send((query + "\n").encode())
+            targetView = memoryview(target.reshape(-1).view(np.uint8))
+            length = self._readBlockHeader()
+            if length is None:
+                data = self._readLine()
+                length = len(data)
+                if length > target.nbytes:
+                    raise ValueError(f"Block of {length} bytes does not fit into target of {target.nbytes} bytes")
+                targetView[0:length] = data
+                return length
+
+            if length > target.nbytes:
+                # Keep the connection usable before reporting the error
+                self._skipBytes(length)
+                self._readLine()
+                raise ValueError(f"Block of {length} bytes does not fit into target of {target.nbytes} bytes")
+            self._readExactlyInto(targetView[0:length])
+            self._readLine()
+            return length
+        except (OSError, CommunicationError):
+            self._dropConnection()
+            raise
+
+    def scpiBatch(self, joined = False):
+        return SCPIBatch(self, joined = joined)
+
+    def _invalidateCache(self, messages):
+        if self._cache is not None:
+            for msg in messages:
+                self._cache.invalidate(msg)
+
+    def _scpiExecutePipelined(self, messages, nQueries):
+        self._invalidateCache(messages)
+        return self._transact(self._scpiPipelined, messages, nQueries)
+
+    def _scpiPipelined(self, messages, nQueries):
+        self._send(("\n".join(messages) + "\n").encode())
+        responses = [ ]
+        for i in range(nQueries):
+            responses.append(self._readLine().decode("utf-8").strip())
+        return responses
+
+    def _scpiExecuteJoined(self, messages, nQueries):
+        self._invalidateCache(messages)
+        return self._transact(self._scpiJoined, messages, nQueries)
+
+    def _scpiJoined(self, messages, nQueries):
+        self._send((";".join(messages) + "\n").encode())
+        if nQueries == 0:
+            return [ ]
+        responses = [ r.strip() for r in self._readLine().decode("utf-8").split(";") ]
+        if len(responses) != nQueries:
+            raise CommunicationError_ProtocolViolation(f"Expected {nQueries} responses, received {len(responses)}")
+        return responses
 
     def scpiCommand(self, command):
-        if not self.isConnected():
-            raise CommunicationError_NotConnected("Device not connected")
-        self._socket.sendall((command + "\n").encode())
+        if self._cache is not None:
+            self._cache.invalidate(command)
+        return self._transact(self._scpiCommand, command)
+
+    def _scpiCommand(self, command):
+        self._send((command + "\n").encode())
         return
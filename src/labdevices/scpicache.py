@@ -0,0 +1,129 @@
+import fnmatch
+import threading
+import time
+
+# Response cache for idempotent SCPI queries
+#
+# An SCPIQueryCache can be attached to an SCPI transport (cache = ... in
+# the constructor or setCache). Only queries whose normalized header
+# matches one of the configured patterns are cached. patterns maps
+# fnmatch style patterns (e.g. "*IDN?", "CHAN*:SCAL?") to a time to
+# live in seconds or None for entries that are only dropped by
+# invalidation. Headers are normalized by stripping the leading colon
+# and converting to uppercase; query arguments are part of the key.
+# Short and long forms of a mnemonic (CHAN vs CHANNEL) are not unified,
+# so a device should consistently use one form.
+#
+# A command passing through the transport invalidates all cached
+# queries with the same header (":CHAN1:SCAL 0.5" drops "CHAN1:SCAL?").
+# Commands listed in clearOn (by default *RST, *RCL and SYST:PRES) as
+# well as a new connection clear the whole cache.
+
+class SCPIQueryCache:
+    defaultPatterns = { "*IDN?" : None, "*OPT?" : None }
+    defaultClearOn = ( "*RST", "*RCL", "SYST:PRES", "SYSTEM:PRESET" )
+
+    def __init__(self, patterns = None, clearOn = None):
+        if patterns is None:
+            patterns = SCPIQueryCache.defaultPatterns
+        if clearOn is None:
+            clearOn = SCPIQueryCache.defaultClearOn
+        if not isinstance(patterns, dict):
+            raise ValueError("Patterns have to be supplied as dictionary mapping patterns to TTLs")
+        if not isinstance(clearOn, (list, tuple, set)):
+            raise ValueError("Clearing commands have to be supplied as list, tuple or set")
+
+        self._patterns = [ ]
+        for pattern, ttl in patterns.items():
+            self.addPattern(pattern, ttl)
+        self._clearOn = set([ SCPIQueryCache.normalize(cmd)[0] for cmd in clearOn ])
+
+        self._entries = { }
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+
+    @staticmethod
+    def normalize(message):
+        # Returns (header, arguments) with uppercase header without
+        # leading colon and whitespace normalized arguments
+        parts = message.strip().split(None, 1)
+        if len(parts) == 0:
+            return ( "", "" )
+        header = parts[0].lstrip(":").upper()
+        arguments = " ".join(parts[1].split()) if len(parts) > 1 else ""
+        return ( header, arguments )
+
+    def addPattern(self, pattern, ttl = None):
+        if not isinstance(pattern, str):
+            raise ValueError("Pattern has to be a string")
+        if (ttl is not None) and (not isinstance(ttl, (int, float)) or (ttl <= 0)):
+            raise ValueError("TTL has to be a positive number or None")
+        pattern = pattern.strip().lstrip(":").upper()
+        if not pattern.endswith("?"):
+            raise ValueError(f"Pattern {pattern} does not match queries")
+        self._patterns.append(( pattern, ttl ))
+
+    def _ttl(self, header):
+        # Returns (cacheable, ttl), the first matching pattern wins
+        for pattern, ttl in self._patterns:
+            if fnmatch.fnmatchcase(header, pattern):
+                return ( True, ttl )
+        return ( False, None )
+
+    def lookup(self, query):
+        # Returns (hit, value)
+        key = SCPIQueryCache.normalize(query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if (expires is None) or (time.monotonic() < expires):
+                    self._hits = self._hits + 1
+                    return ( True, value )
+                del self._entries[key]
+            if self._ttl(key[0])[0]:
+                self._misses = self._misses + 1
+        return ( False, None )
+
+    def store(self, query, value):
+        key = SCPIQueryCache.normalize(query)
+        cacheable, ttl = self._ttl(key[0])
+        if not cacheable:
+            return
+        expires = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self._entries[key] = ( value, expires )
+
+    def invalidate(self, command):
+        # Joined program messages ("A 1;B 2") invalidate every part
+        for message in command.split(";"):
+            header, _ = SCPIQueryCache.normalize(message)
+            if (len(header) == 0) or header.endswith("?"):
+                continue
+            with self._lock:
+                if len(self._entries) == 0:
+                    return
+                if header in self._clearOn:
+                    self._invalidations = self._invalidations + 1
+                    self._entries = { }
+                    return
+                keys = [ key for key in self._entries if key[0] == header + "?" ]
+                for key in keys:
+                    del self._entries[key]
+                if len(keys) > 0:
+                    self._invalidations = self._invalidations + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries = { }
+
+    def statistics(self):
+        with self._lock:
+            return {
+                'entries' : len(self._entries),
+                'hits' : self._hits,
+                'misses' : self._misses,
+                'invalidations' : self._invalidations
+            }
@@ -0,0 +1,154 @@
+import bisect
+import heapq
+import threading
+import time
+
+# Transport metrics for SCPI devices
+#
+# An SCPITransportMetrics instance can be attached to an SCPI transport
+# (metrics = ... in the constructor or setMetrics). The transport then
+# reports every operation with the time spent sending, waiting for the
+# first response byte (device think time) and receiving the rest of the
+# response. Operations are aggregated per mnemonic (the uppercase
+# header of the message) into latency histograms, the slowest
+# operations are kept and all counters can be exported with snapshot().
+# Hooks registered with addHook are called with every single record
+# so they can be forwarded to an external monitoring system. Exceptions
+# raised by hooks never reach the instrument I/O; they are counted
+# (hookErrors in snapshot) and the last one is kept in lastHookError.
+#
+# Without metrics attached the transport only performs a None check.
+
+class SCPITransportMetrics:
+    # Default histogram bucket upper edges in seconds (10 us ... 10 s)
+    defaultBuckets = ( 1e-5, 3e-5, 1e-4, 3e-4, 1e-3, 3e-3, 1e-2, 3e-2, 1e-1, 3e-1, 1.0, 3.0, 10.0 )
+
+    def __init__(self, buckets = None, slowestCount = 10):
+        if buckets is None:
+            buckets = SCPITransportMetrics.defaultBuckets
+        if not isinstance(buckets, (list, tuple)) or (len(buckets) < 1):
+            raise ValueError("Buckets have to be a non empty list or tuple")
+        if list(buckets) != sorted(buckets):
+            raise ValueError("Bucket edges have to be sorted")
+        if not isinstance(slowestCount, int) or (slowestCount < 0):
+            raise ValueError("Number of slowest operations has to be a non negative integer")
+
+        self._buckets = tuple(buckets)
+        self._slowestCount = slowestCount
+        self._hooks = [ ]
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._queries = 0
+            self._commands = 0
+            self._errors = 0
+            self._bytesOut = 0
+            self._bytesIn = 0
+            self._perMnemonic = { }
+            self._slowest = [ ]
+            self._sequence = 0
+            self._hookErrors = 0
+            self.lastHookError = None
+
+    def addHook(self, hook):
+        if not callable(hook):
+            raise ValueError("Hook has to be callable")
+        with self._lock:
+            self._hooks.append(hook)
+
+    def removeHook(self, hook):
+        with self._lock:
+            if hook in self._hooks:
+                self._hooks.remove(hook)
+
+    def record(self, mnemonic, isQuery, bytesOut, bytesIn, sendTime, waitTime, receiveTime, error = None):
+        totalTime = sendTime + waitTime + receiveTime
+        rec = {
+            'mnemonic' : mnemonic,
+            'query' : isQuery,
+            'bytesOut' : bytesOut,
+            'bytesIn' : bytesIn,
+            'sendTime' : sendTime,
+            'waitTime' : waitTime,
+            'receiveTime' : receiveTime,
+            'totalTime' : totalTime,
+            'error' : error,
+            'timestamp' : time.time()
+        }
+
+        with self._lock:
+            if isQuery:
+                self._queries = self._queries + 1
+            else:
+                self._commands = self._commands + 1
+            if error is not None:
+                self._errors = self._errors + 1
+            self._bytesOut = self._bytesOut + bytesOut
+            self._bytesIn = self._bytesIn + bytesIn
+
+            stats = self._perMnemonic.get(mnemonic)
+            if stats is None:
+                stats = {
+                    'count' : 0,
+                    'errors' : 0,
+                    'totalTime' : 0.0,
+                    'sendTime' : 0.0,
+                    'waitTime' : 0.0,
+                    'receiveTime' : 0.0,
+                    'minTime' : totalTime,
+                    'maxTime' : totalTime,
+                    'histogram' : [ 0 ] * (len(self._buckets) + 1)
+                }
+                self._perMnemonic[mnemonic] = stats
+            stats['count'] = stats['count'] + 1
+            if error is not None:
+                stats['errors'] = stats['errors'] + 1
+            stats['totalTime'] = stats['totalTime'] + totalTime
+            stats['sendTime'] = stats['sendTime'] + sendTime
+            stats['waitTime'] = stats['waitTime'] + waitTime
+            stats['receiveTime'] = stats['receiveTime'] + receiveTime
+            stats['minTime'] = min(stats['minTime'], totalTime)
+            stats['maxTime'] = max(stats['maxTime'], totalTime)
+            stats['histogram'][bisect.bisect_left(self._buckets, totalTime)] += 1
+
+            if self._slowestCount > 0:
+                # Min heap keeps the slowest operations, the sequence
+                # number avoids comparing the dictionaries
+                self._sequence = self._sequence + 1
+                entry = ( totalTime, self._sequence, rec )
+                if len(self._slowest) < self._slowestCount:
+                    heapq.heappush(self._slowest, entry)
+                elif totalTime > self._slowest[0][0]:
+                    heapq.heapreplace(self._slowest, entry)
+
+            hooks = list(self._hooks)
+
+        for hook in hooks:
+            try:
+                hook(rec)
+            except Exception as e:
+                with self._lock:
+                    self._hookErrors = self._hookErrors + 1
+                    self.lastHookError = e
+
+    def snapshot(self):
+        with self._lock:
+            perMnemonic = { }
+            for mnemonic, stats in self._perMnemonic.items():
+                perMnemonic[mnemonic] = dict(stats)
+                perMnemonic[mnemonic]['histogram'] = list(stats['histogram'])
+                perMnemonic[mnemonic]['meanTime'] = stats['totalTime'] / stats['count']
+
+            return {
+                'queries' : self._queries,
+                'commands' : self._commands,
+                'errors' : self._errors,
+                'bytesOut' : self._bytesOut,
+                'bytesIn' : self._bytesIn,
+                'hookErrors' : self._hookErrors,
+                'buckets' : list(self._buckets),
+                'perMnemonic' : perMnemonic,
+                'slowest' : [ dict(e[2]) for e in sorted(self._slowest, key = lambda e: e[0], reverse = True) ]
+            }
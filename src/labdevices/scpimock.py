@@ -0,0 +1,291 @@
+# Local SCPI instrument simulator for tests and benchmarks
+#
+# SCPIMockServer listens on a local TCP port (port 0 selects a free port)
+# and answers newline terminated SCPI messages. Program messages joined
+# by ";" are split and the responses are joined by ";" again.
+#
+# Responses are looked up by the uppercase header (the part before the
+# first space, without leading colon) in the responses dictionary. A value can be
+#
+#   - a string, answered with a trailing newline
+#   - bytes (e.g. an IEEE 488.2 block built with ieeeBlock), sent as is
+#     with a trailing newline
+#   - a callable receiving (header, arguments) and returning one of the
+#     above or None for no response
+#
+# Commands without explicit handler store their arguments so a later
+# query of the same header returns the value that has been set. *IDN?
+# is answered with idn. Unknown queries are not answered (like a real
+# instrument that only pushes an error to its error queue) and are
+# collected in errors.
+#
+# Faults can be injected: latency delays each response, fragmentSize
+# splits responses into fragments sent fragmentDelay seconds apart,
+# disconnectAfter closes a connection after that many messages and
+# disconnectAll() drops all clients immediately.
+#
+# The server can also be run as separate process:
+#
+#   python -m labdevices.scpimock --port 5025 --latency 0.001
+#
+# spawnSCPIMockServer starts such a subprocess and returns it together
+# with the port it listens on.
+
+import argparse
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+
+def ieeeBlock(data):
+    if isinstance(data, np.ndarray):
+        data = data.tobytes()
+    data = bytes(data)
+    length = str(len(data))
+    return ("#" + str(len(length)) + length).encode() + data
+
+class SCPIMockServer:
+    def __init__(
+        self,
+        address = "127.0.0.1",
+        port = 0,
+
+        responses = None,
+        idn = "labdevices,SCPIMockServer,0,0",
+
+        latency = 0,
+        fragmentSize = None,
+        fragmentDelay = 0,
+        disconnectAfter = None
+    ):
+        if not isinstance(port, int) or (port < 0) or (port > 65535):
+            raise ValueError("Port is out of range 0-65535")
+        if responses is None:
+            responses = { }
+        if not isinstance(responses, dict):
+            raise ValueError("Responses have to be supplied as dictionary")
+        if not isinstance(latency, (int, float)) or (latency < 0):
+            raise ValueError("Latency has to be a non negative number")
+        if (fragmentSize is not None) and (not isinstance(fragmentSize, int) or (fragmentSize < 1)):
+            raise ValueError("Fragment size has to be a positive integer or None")
+        if not isinstance(fragmentDelay, (int, float)) or (fragmentDelay < 0):
+            raise ValueError("Fragment delay has to be a non negative number")
+        if (disconnectAfter is not None) and (not isinstance(disconnectAfter, int) or (disconnectAfter < 1)):
+            raise ValueError("Disconnect after has to be a positive integer or None")
+
+        self._address = address
+        self._port = port
+        self._responses = { }
+        for header, response in responses.items():
+            self.setResponse(header, response)
+        self._idn = idn
+
+        self.latency = latency
+        self.fragmentSize = fragmentSize
+        self.fragmentDelay = fragmentDelay
+        self.disconnectAfter = disconnectAfter
+
+        self._state = { }
+        self._lock = threading.Lock()
+        self._listenSocket = None
+        self._acceptThread = None
+        self._clients = [ ]
+        self._running = False
+
+        self.received = [ ]
+        self.errors = [ ]
+        self.connections = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def address(self):
+        return self._address
+
+    @property
+    def port(self):
+        return self._port
+
+    def setResponse(self, header, response):
+        self._responses[header.strip().lstrip(":").upper()] = response
+
+    def _respond(self, message):
+        message = message.strip()
+        if len(message) == 0:
+            return None
+        parts = message.split(" ", 1)
+        header = parts[0].lstrip(":").upper()
+        arguments = parts[1].strip() if len(parts) > 1 else None
+
+        if header in self._responses:
+            response = self._responses[header]
+            if callable(response):
+                response = response(header, arguments)
+            if header.endswith("?"):
+                return response
+            return None
+
+        if header.endswith("?"):
+            if header == "*IDN?":
+                return self._idn
+            with self._lock:
+                if header[:-1] in self._state:
+                    return self._state[header[:-1]]
+            self.errors.append(message)
+            return None
+
+        with self._lock:
+            self._state[header] = arguments
+        return None
+
+    def _send(self, conn, data):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if self.fragmentSize is None:
+            conn.sendall(data)
+            return
+        for pos in range(0, len(data), self.fragmentSize):
+            if (pos > 0) and (self.fragmentDelay > 0):
+                time.sleep(self.fragmentDelay)
+            conn.sendall(data[pos:pos + self.fragmentSize])
+
+    def _handle(self, conn):
+        rxBuffer = bytearray()
+        messages = 0
+        try:
+            while self._running:
+                idx = rxBuffer.find(b"\n")
+                if idx < 0:
+                    data = conn.recv(65536)
+                    if len(data) == 0:
+                        break
+                    rxBuffer += data
+                    continue
+
+                line = rxBuffer[0:idx].decode("utf-8", errors = "replace")
+                del rxBuffer[0:idx + 1]
+                self.received.append(line.strip())
+                messages = messages + 1
+
+                responses = [ ]
+                for message in line.split(";"):
+                    response = self._respond(message)
+                    if response is not None:
+                        responses.append(response.encode() if isinstance(response, str) else bytes(response))
+                if len(responses) > 0:
+                    self._send(conn, b";".join(responses) + b"\n")
+
+                if (self.disconnectAfter is not None) and (messages >= self.disconnectAfter):
+                    break
+        except OSError:
+            pass
+        finally:
+            self._closeClient(conn)
+
+    def _closeClient(self, conn):
+        with self._lock:
+            if conn in self._clients:
+                self._clients.remove(conn)
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        conn.close()
+
+    def _accept(self):
+        while self._running:
+            try:
+                conn, _ = self._listenSocket.accept()
+            except OSError:
+                break
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self._lock:
+                self._clients.append(conn)
+                self.connections = self.connections + 1
+            threading.Thread(target = self._handle, args = ( conn, ), daemon = True).start()
+
+    def start(self):
+        if self._running:
+            raise ValueError("Mock server is already running")
+
+        self._listenSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listenSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listenSocket.bind((self._address, self._port))
+        self._listenSocket.listen(16)
+        self._port = self._listenSocket.getsockname()[1]
+
+        self._running = True
+        self._acceptThread = threading.Thread(target = self._accept, daemon = True)
+        self._acceptThread.start()
+        return ( self._address, self._port )
+
+    def disconnectAll(self):
+        with self._lock:
+            clients = list(self._clients)
+        for conn in clients:
+            self._closeClient(conn)
+
+    def stop(self):
+        if not self._running:
+            return
+        self._running = False
+        try:
+            self._listenSocket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._listenSocket.close()
+        self._acceptThread.join()
+        self.disconnectAll()
+
+def spawnSCPIMockServer(port = 0, latency = 0, fragmentSize = None, fragmentDelay = 0, idn = None):
+    args = [ sys.executable, "-m", "labdevices.scpimock", "--port", str(port), "--latency", str(latency), "--fragment-delay", str(fragmentDelay) ]
+    if fragmentSize is not None:
+        args = args + [ "--fragment-size", str(fragmentSize) ]
+    if idn is not None:
+        args = args + [ "--idn", idn ]
+
+    proc = subprocess.Popen(args, stdout = subprocess.PIPE, text = True)
+    line = proc.stdout.readline().split()
+    if (len(line) != 3) or (line[0] != "LISTENING"):
+        proc.kill()
+        raise RuntimeError("Mock server subprocess failed to start")
+    return proc, int(line[2])
+
+def main():
+    parser = argparse.ArgumentParser(description = "Local SCPI mock instrument")
+    parser.add_argument("--address", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 5025)
+    parser.add_argument("--latency", type = float, default = 0)
+    parser.add_argument("--fragment-size", type = int, default = None)
+    parser.add_argument("--fragment-delay", type = float, default = 0)
+    parser.add_argument("--idn", default = "labdevices,SCPIMockServer,0,0")
+    args = parser.parse_args()
+
+    server = SCPIMockServer(
+        address = args.address,
+        port = args.port,
+        idn = args.idn,
+        latency = args.latency,
+        fragmentSize = args.fragment_size,
+        fragmentDelay = args.fragment_delay
+    )
+    address, port = server.start()
+    print(f"LISTENING {address} {port}", flush = True)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+import socket
+import threading
+import time
+
+from .exceptions import CommunicationError_NotConnected
+from .scpi import SCPIDeviceEthernet
+
+# Shared SCPI sessions
+#
+# Many instruments accept only one or very few LAN sessions. The
+# SCPISessionManager keeps one SCPIDeviceEthernet connection per
+# (address, port) and hands out reference counted SCPISharedSession
+# handles. Each handle exposes the usual scpiQuery / scpiCommand /
+# scpiQueryBinary surface; all calls are serialized by a per
+# connection lock which can also be held explicitly (with session.lock)
+# to run multi message transactions. Connections without any handle
+# are closed after idleTimeout seconds. Before a connection is reused a
+# health check (by default a check whether the peer closed the socket)
+# is run and dead connections are replaced transparently.
+#
+# Connection options (timeouts, keepalive, ...) are taken from the
+# acquire call that opened the connection.
+#
+# The health check and connection setup run without holding the
+# manager lock so a thread holding session.lock can always acquire
+# or release other sessions. A connection whose lock is currently held
+# by another thread is in use and considered healthy.
+
+def _socketAlive(device):
+    sock = device._socket
+    if sock is None:
+        return False
+    prev = sock.gettimeout()
+    try:
+        sock.setblocking(False)
+        data = sock.recv(1, socket.MSG_PEEK)
+        return len(data) > 0
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.settimeout(prev)
+
+class _SCPISessionEntry:
+    def __init__(self, key, device):
+        self.key = key
+        self.device = device
+        self.lock = threading.RLock()
+        self.refcount = 0
+        self.lastUsed = time.monotonic()
+        self.timer = None
+
+class SCPISharedSession:
+    def __init__(self, manager, entry):
+        self._manager = manager
+        self._entry = entry
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.disconnect()
+
+    def _device(self):
+        if self._entry is None:
+            raise CommunicationError_NotConnected("Session has already been released")
+        return self._entry.device
+
+    @property
+    def lock(self):
+        if self._entry is None:
+            raise CommunicationError_NotConnected("Session has already been released")
+        return self._entry.lock
+
+    def connect(self):
+        return self.isConnected()
+
+    def disconnect(self):
+        if self._entry is not None:
+            entry = self._entry
+            self._entry = None
+            self._manager._release(entry)
+
+    def isConnected(self):
+        return (self._entry is not None) and self._entry.device.isConnected()
+
+    def scpiQuery(self, query):
+        with self.lock:
+            return self._device().scpiQuery(query)
+
+    def scpiQueryBinary(self, *args, **kwargs):
+        with self.lock:
+            return self._device().scpiQueryBinary(*args, **kwargs)
+
+    def scpiCommand(self, command):
+        with self.lock:
+            return self._device().scpiCommand(command)
+
+class SCPISessionManager:
+    def __init__(self, idleTimeout = 30, healthCheck = _socketAlive):
+        if not isinstance(idleTimeout, (int, float)) or (idleTimeout < 0):
+            raise ValueError("Idle timeout has to be a non negative number")
+        if (healthCheck is not None) and not callable(healthCheck):
+            raise ValueError("Health check has to be callable or None")
+
+        self._idleTimeout = idleTimeout
+        self._healthCheck = healthCheck
+        self._entries = { }
+        self._lock = threading.Lock()
+
+    def _healthy(self, entry):
+        if not entry.device.isConnected():
+            return False
+        if self._healthCheck is None:
+            return True
+        if not entry.lock.acquire(False):
+            return True
+        try:
+            return bool(self._healthCheck(entry.device))
+        except Exception:
+            return False
+        finally:
+            entry.lock.release()
+
+    def _close(self, entry):
+        if entry.timer is not None:
+            entry.timer.cancel()
+            entry.timer = None
+        try:
+            entry.device.disconnect()
+        except OSError:
+            pass
+
+    def _reserve(self, entry):
+        # Has to be called with the manager lock held
+        if entry.timer is not None:
+            entry.timer.cancel()
+            entry.timer = None
+        entry.refcount = entry.refcount + 1
+        entry.lastUsed = time.monotonic()
+
+    def acquire(self, address, port = 5025, **deviceOptions):
+        key = (address, port)
+
+        # Reserve an existing connection so it cannot expire while the
+        # health check runs outside of the manager lock
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._reserve(entry)
+
+        if entry is not None:
+            if self._healthy(entry):
+                return SCPISharedSession(self, entry)
+            with self._lock:
+                entry.refcount = entry.refcount - 1
+                if self._entries.get(key) is entry:
+                    del self._entries[key]
+            # Existing handles keep the dead device and fail on use
+            self._close(entry)
+
+        device = SCPIDeviceEthernet(address, port, **deviceOptions)
+        device.connect()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = _SCPISessionEntry(key, device)
+                self._entries[key] = entry
+                device = None
+            self._reserve(entry)
+
+        if device is not None:
+            # Another thread opened the connection in the meantime
+            try:
+                device.disconnect()
+            except OSError:
+                pass
+        return SCPISharedSession(self, entry)
+
+    def _release(self, entry):
+        with self._lock:
+            entry.refcount = entry.refcount - 1
+            entry.lastUsed = time.monotonic()
+            if entry.refcount > 0:
+                return
+            if self._entries.get(entry.key) is not entry:
+                # Already replaced after a failed health check
+                self._close(entry)
+                return
+            if self._idleTimeout == 0:
+                del self._entries[entry.key]
+                self._close(entry)
+                return
+            entry.timer = threading.Timer(self._idleTimeout, self._expire, args = ( entry, ))
+            entry.timer.daemon = True
+            entry.timer.start()
+
+    def _expire(self, entry):
+        with self._lock:
+            if (entry.refcount == 0) and (self._entries.get(entry.key) is entry):
+                del self._entries[entry.key]
+                self._close(entry)
+
+    def evictIdle(self):
+        now = time.monotonic()
+        with self._lock:
+            for key in list(self._entries.keys()):
+                entry = self._entries[key]
+                if (entry.refcount == 0) and (now - entry.lastUsed >= self._idleTimeout):
+                    del self._entries[key]
+                    self._close(entry)
+
+    def closeAll(self):
+        with self._lock:
+            for entry in self._entries.values():
+                self._close(entry)
+            self._entries = { }
+
+    def sessions(self):
+        with self._lock:
+            return {
+                key : { 'refcount' : entry.refcount, 'idle' : time.monotonic() - entry.lastUsed }
+                for key, entry in self._entries.items()
+            }
+
+_defaultSessionManager = None
+_defaultSessionManagerLock = threading.Lock()
+
+def defaultSCPISessionManager():
+    global _defaultSessionManager
+    with _defaultSessionManagerLock:
+        if _defaultSessionManager is None:
+            _defaultSessionManager = SCPISessionManager()
+        return _defaultSessionManager
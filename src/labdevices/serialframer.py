@@ -0,0 +1,370 @@
+# Frame extraction on top of a (binary) SerialRingBuffer
+#
+# The framers operate directly on the ring buffer storage. Each framer
+# remembers how far the buffered data has already been scanned without
+# finding the end of a frame so data is never scanned twice - a frame
+# that arrives in many small chunks costs O(n) instead of O(n^2). This
+# requires that the framer is the only consumer of the ring buffer.
+#
+# Complete frames are returned as bytes by read_frame (non blocking),
+# wait_frame (blocking with timeout) or by iterating over frames().
+#
+# Available framers:
+#
+#   - DelimiterFramer splits at a delimiter (default newline)
+#   - FixedLengthFramer returns frames of a constant length
+#   - LengthPrefixFramer reads the frame length from a header field
+#   - StartStopFramer extracts data between start and stop markers and
+#     skips garbage in front of the start marker
+#
+# Frames exceeding maxFrameLength are dropped and counted in
+# discarded(). If the end of an oversized frame has not been received
+# yet the framer keeps discarding data up to the next frame boundary
+# (delimiter, declared frame length or start marker) so the tail of the
+# oversized frame is never returned as a frame.
+
+import time
+
+from .serialringbuffer import SerialRingBuffer
+
+class SerialFramer:
+    def __init__(self, ringBuffer, maxFrameLength = None):
+        if not isinstance(ringBuffer, SerialRingBuffer):
+            raise ValueError("Ring buffer has to be a SerialRingBuffer")
+        if not ringBuffer.binary:
+            raise ValueError("Framers require a ring buffer in binary mode")
+        if maxFrameLength is not None:
+            if not isinstance(maxFrameLength, int):
+                raise ValueError("Maximum frame length has to be an integer")
+            if maxFrameLength < 1:
+                raise ValueError("Maximum frame length has to be positive")
+
+        self._ring = ringBuffer
+        self._maxFrameLength = maxFrameLength
+        self._scanned = 0
+        self._discarded = 0
+        self._resyncing = False
+
+    # Overriden "protected" methods
+
+    def _extract(self):
+        # Called with the ring buffer locked. Returns either None (frame
+        # not complete yet) or a tuple (skip, length, consume): skip bytes
+        # before the frame payload, length bytes payload and consume bytes
+        # that are removed from the buffer in total
+        raise NotImplementedError()
+
+    def _overflowThreshold(self):
+        # Buffered bytes without a complete frame beyond which the frame
+        # cannot end up within maxFrameLength (the returned frame does
+        # not include e.g. a partially received delimiter)
+        return self._maxFrameLength
+
+    def _overflowKeep(self):
+        # Number of bytes kept when an oversized frame is dropped since
+        # they might belong to the next frame boundary
+        return 0
+
+    def _overflow(self, dropped):
+        # Called with the ring buffer locked after dropped bytes of an
+        # oversized frame have been discarded
+        pass
+
+    def _resync(self):
+        # Called with the ring buffer locked after an overflow. Discards
+        # the rest of the oversized frame and returns True as soon as
+        # the next frame starts at the beginning of the buffer
+        return True
+
+    # Helpers for implementations
+
+    def _drop(self, n):
+        if n > 0:
+            self._ring.discard(n, blocking = False)
+            self._discarded = self._discarded + n
+
+    def _peekBytes(self, offset, length):
+        views = self._ring.peek_view(offset + length, blocking = False)
+        data = b"".join(views)
+        if len(data) < offset + length:
+            return None
+        return data[offset:]
+
+    def _consume(self, skip, length, consume):
+        frame = None
+        if length > 0:
+            self._ring.discard(skip, blocking = False)
+            frame = self._ring.read(length, blocking = False)
+            self._ring.discard(consume - skip - length, blocking = False)
+        else:
+            self._ring.discard(consume, blocking = False)
+            frame = b""
+        self._scanned = 0
+        return frame
+
+    def _readFrame(self):
+        # Returns (frame, None) or (None, avail) with the number of bytes
+        # that have been buffered when extracting a frame failed
+        with self._ring.lock:
+            while True:
+                before = self._ring.available(blocking = False)
+                discardedBefore = self._discarded
+
+                res = None
+                if self._resyncing:
+                    if self._resync():
+                        self._resyncing = False
+                        self._scanned = 0
+                        continue
+                else:
+                    res = self._extract()
+
+                if res is not None:
+                    if (self._maxFrameLength is not None) and (res[1] > self._maxFrameLength):
+                        # Complete but oversized frame
+                        self._consume(*res)
+                        self._discarded = self._discarded + res[2]
+                        continue
+                    return ( self._consume(*res), None )
+
+                # In SPSC mode the producer may have pushed data (e.g. the
+                # missing delimiter) during the scan. Retry so the returned
+                # count only includes data that has been scanned
+                avail = self._ring.available(blocking = False)
+                if avail != before - (self._discarded - discardedBefore):
+                    continue
+
+                if (not self._resyncing) and (self._maxFrameLength is not None):
+                    if avail > self._overflowThreshold():
+                        # Oversized frame, drop everything scanned so far
+                        # and the rest of the frame once it arrives
+                        dropped = avail - self._overflowKeep()
+                        self._drop(dropped)
+                        self._scanned = 0
+                        self._overflow(dropped)
+                        self._resyncing = True
+                        continue
+                return ( None, avail )
+
+    # Public API
+
+    def discarded(self):
+        return self._discarded
+
+    def reset(self):
+        with self._ring.lock:
+            self._scanned = 0
+            self._resyncing = False
+
+    def read_frame(self):
+        return self._readFrame()[0]
+
+    def frames(self):
+        while True:
+            frame = self.read_frame()
+            if frame is None:
+                return
+            yield frame
+
+    def __iter__(self):
+        return self.frames()
+
+    def wait_frame(self, timeout = None):
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+
+        while True:
+            frame, avail = self._readFrame()
+            if frame is not None:
+                return frame
+
+            if avail >= self._ring.capacity() - 1:
+                # Buffer full without a complete frame, cannot progress
+                return None
+
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+            self._ring.wait_available(avail + 1, remaining)
+
+class DelimiterFramer(SerialFramer):
+    def __init__(self, ringBuffer, delimiter = b"\n", includeDelimiter = False, maxFrameLength = None):
+        super().__init__(ringBuffer, maxFrameLength = maxFrameLength)
+
+        if isinstance(delimiter, str):
+            delimiter = delimiter.encode()
+        if not isinstance(delimiter, (bytes, bytearray)):
+            raise ValueError("Delimiter has to be bytes or string")
+        if len(delimiter) < 1:
+            raise ValueError("Delimiter must not be empty")
+
+        self._delimiter = bytes(delimiter)
+        self._includeDelimiter = includeDelimiter
+
+    def _extract(self):
+        idx = self._ring._find(self._delimiter, self._scanned)
+        if idx < 0:
+            self._scanned = max(0, self._ring.available(blocking = False) - len(self._delimiter) + 1)
+            return None
+        if self._includeDelimiter:
+            return ( 0, idx + len(self._delimiter), idx + len(self._delimiter) )
+        return ( 0, idx, idx + len(self._delimiter) )
+
+    def _overflowThreshold(self):
+        # Without the delimiter in the frame up to len(delimiter) - 1
+        # buffered bytes may be the start of the terminating delimiter
+        if self._includeDelimiter:
+            return self._maxFrameLength - 1
+        return self._maxFrameLength + len(self._delimiter) - 1
+
+    def _overflowKeep(self):
+        return len(self._delimiter) - 1
+
+    def _resync(self):
+        idx = self._ring._find(self._delimiter, 0)
+        if idx < 0:
+            # Keep a possibly incomplete delimiter
+            self._drop(max(0, self._ring.available(blocking = False) - len(self._delimiter) + 1))
+            return False
+        self._drop(idx + len(self._delimiter))
+        return True
+
+class FixedLengthFramer(SerialFramer):
+    def __init__(self, ringBuffer, length):
+        if not isinstance(length, int):
+            raise ValueError("Frame length has to be an integer")
+        if length < 1:
+            raise ValueError("Frame length has to be positive")
+        super().__init__(ringBuffer)
+
+        self._length = length
+
+    def _extract(self):
+        if self._ring.available(blocking = False) < self._length:
+            return None
+        return ( 0, self._length, self._length )
+
+class LengthPrefixFramer(SerialFramer):
+    # The length field of prefixLength bytes starts prefixOffset bytes
+    # after the frame start. The number of bytes following the length
+    # field is the field value plus lengthAdjust. The returned frame
+    # contains the header (including the length field) in case
+    # includeHeader is set
+    def __init__(
+        self,
+        ringBuffer,
+
+        prefixLength = 1,
+        prefixOffset = 0,
+        byteorder = "big",
+        lengthAdjust = 0,
+        includeHeader = False,
+
+        maxFrameLength = None
+    ):
+        super().__init__(ringBuffer, maxFrameLength = maxFrameLength)
+
+        if prefixLength not in [ 1, 2, 3, 4, 8 ]:
+            raise ValueError(f"Length prefix of {prefixLength} bytes is not supported")
+        if not isinstance(prefixOffset, int) or (prefixOffset < 0):
+            raise ValueError("Prefix offset has to be a non negative integer")
+        if byteorder not in [ "big", "little" ]:
+            raise ValueError("Byte order has to be big or little")
+        if not isinstance(lengthAdjust, int):
+            raise ValueError("Length adjustment has to be an integer")
+
+        self._prefixLength = prefixLength
+        self._prefixOffset = prefixOffset
+        self._byteorder = byteorder
+        self._lengthAdjust = lengthAdjust
+        self._includeHeader = includeHeader
+        self._skipRemaining = 0
+        self._declaredLength = 0
+
+    def _frameLength(self):
+        # Returns (headerLength, payloadLength) or None if the header is
+        # not complete yet
+        field = self._peekBytes(self._prefixOffset, self._prefixLength)
+        if field is None:
+            return None
+        payloadLength = int.from_bytes(field, self._byteorder) + self._lengthAdjust
+        return ( self._prefixOffset + self._prefixLength, max(0, payloadLength) )
+
+    def _overflowThreshold(self):
+        if self._includeHeader:
+            return self._maxFrameLength
+        return self._maxFrameLength + self._prefixOffset + self._prefixLength
+
+    def _overflow(self, dropped):
+        # _extract only fails with an oversized buffer if the declared
+        # frame length is larger than the buffered data
+        self._skipRemaining = max(0, self._declaredLength - dropped)
+
+    def _resync(self):
+        skip = min(self._skipRemaining, self._ring.available(blocking = False))
+        self._drop(skip)
+        self._skipRemaining = self._skipRemaining - skip
+        return self._skipRemaining == 0
+
+    def _extract(self):
+        lengths = self._frameLength()
+        self._declaredLength = 0
+        if lengths is None:
+            return None
+        headerLength, payloadLength = lengths
+        self._declaredLength = headerLength + payloadLength
+        if self._ring.available(blocking = False) < headerLength + payloadLength:
+            return None
+        if self._includeHeader:
+            return ( 0, headerLength + payloadLength, headerLength + payloadLength )
+        return ( headerLength, payloadLength, headerLength + payloadLength )
+
+class StartStopFramer(SerialFramer):
+    def __init__(self, ringBuffer, start, stop, includeMarkers = False, maxFrameLength = None):
+        super().__init__(ringBuffer, maxFrameLength = maxFrameLength)
+
+        if isinstance(start, int):
+            start = bytes(( start, ))
+        if isinstance(stop, int):
+            stop = bytes(( stop, ))
+        if not isinstance(start, (bytes, bytearray)) or not isinstance(stop, (bytes, bytearray)):
+            raise ValueError("Start and stop markers have to be bytes or integers")
+        if (len(start) < 1) or (len(stop) < 1):
+            raise ValueError("Start and stop markers must not be empty")
+
+        self._start = bytes(start)
+        self._stop = bytes(stop)
+        self._includeMarkers = includeMarkers
+
+    def _overflowThreshold(self):
+        # Markers are only part of the frame with includeMarkers
+        if self._includeMarkers:
+            return self._maxFrameLength - 1
+        return self._maxFrameLength + len(self._start) + len(self._stop) - 1
+
+    def _extract(self):
+        if self._scanned == 0:
+            # Synchronize on the start marker, skipping garbage
+            idx = self._ring._find(self._start, 0)
+            if idx < 0:
+                garbage = max(0, self._ring.available(blocking = False) - len(self._start) + 1)
+                self._ring.discard(garbage, blocking = False)
+                self._discarded = self._discarded + garbage
+                return None
+            if idx > 0:
+                self._ring.discard(idx, blocking = False)
+                self._discarded = self._discarded + idx
+            self._scanned = len(self._start)
+
+        idx = self._ring._find(self._stop, self._scanned)
+        if idx < 0:
+            self._scanned = max(len(self._start), self._ring.available(blocking = False) - len(self._stop) + 1)
+            return None
+
+        total = idx + len(self._stop)
+        if self._includeMarkers:
+            return ( 0, total, total )
+        return ( len(self._start), idx - len(self._start), total )
@@ -0,0 +1,180 @@
+# Background reader thread feeding a (binary) SerialRingBuffer
+#
+# The reader wraps a readable file descriptor, a socket or a pyserial
+# like object. Whenever the source is readable it reads as much data as
+# is available (up to chunkSize) with a single call directly into the
+# free space of the ring buffer - for plain file descriptors a single
+# readv fills both free regions in case the free space wraps around.
+# In case the ring is full and uses the BLOCK overflow policy the
+# thread stops reading from the source until the consumer frees space
+# (so the source applies back pressure). For all other policies data is
+# read into a scratch buffer and pushed so the overflow policy applies.
+#
+# The thread has to be the only producer of the ring buffer. It stops
+# on stop(), on end of file or on a read error (stored in error).
+
+import os
+import select
+import threading
+
+from .serialringbuffer import SerialRingBuffer, SerialRingBufferOverflowPolicy
+
+class SerialReaderThread:
+    def __init__(self, source, ringBuffer, chunkSize = 4096, pollInterval = 0.1):
+        if not isinstance(ringBuffer, SerialRingBuffer):
+            raise ValueError("Ring buffer has to be a SerialRingBuffer")
+        if not ringBuffer.binary:
+            raise ValueError("Reader requires a ring buffer in binary mode")
+        if not isinstance(chunkSize, int) or (chunkSize < 1):
+            raise ValueError("Chunk size has to be a positive integer")
+        if not isinstance(pollInterval, (int, float)) or (pollInterval <= 0):
+            raise ValueError("Poll interval has to be a positive number")
+
+        if isinstance(source, int):
+            self._fd = source
+        else:
+            if not (hasattr(source, "recv_into") or hasattr(source, "readinto") or hasattr(source, "read")):
+                raise ValueError("Source has to be a file descriptor or provide recv_into, readinto or read")
+            try:
+                self._fd = source.fileno()
+            except Exception:
+                self._fd = None
+
+        self._source = source
+        self._ring = ringBuffer
+        self._chunkSize = chunkSize
+        self._pollInterval = pollInterval
+        self._scratch = bytearray(chunkSize)
+
+        self._thread = None
+        self._stop = threading.Event()
+        self._wakeup = None
+
+        self.error = None
+        self.eof = False
+        self.bytesRead = 0
+        self.reads = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _readIntoViews(self, views):
+        if isinstance(self._source, int):
+            if hasattr(os, "readv"):
+                return os.readv(self._source, views)
+            data = os.read(self._source, sum([ len(v) for v in views ]))
+            views[0][0:len(data)] = data
+            return len(data)
+
+        view = views[0]
+        if hasattr(self._source, "in_waiting"):
+            # pyserial read(n) blocks until n bytes arrived
+            n = min(len(view), max(1, self._source.in_waiting))
+            view = view[0:n]
+        if hasattr(self._source, "recv_into"):
+            return self._source.recv_into(view)
+        if hasattr(self._source, "readinto"):
+            res = self._source.readinto(view)
+            return 0 if res is None else res
+
+        data = self._source.read(len(view))
+        if data is None:
+            return 0
+        view[0:len(data)] = data
+        return len(data)
+
+    def _readOnce(self):
+        views = list(self._ring.free_view(self._chunkSize))
+        if len(views) > 0:
+            n = self._readIntoViews(views)
+            if n is None:
+                n = 0
+            if n > 0:
+                self._ring.commit(n)
+        else:
+            # Never reads more than fits into an empty ring
+            n = self._readIntoViews([ memoryview(self._scratch)[0:min(self._chunkSize, self._ring.capacity() - 1)] ])
+            if n is None:
+                n = 0
+            if n > 0:
+                self._ring.push(memoryview(self._scratch)[0:n])
+        return n
+
+    def _waitSpace(self):
+        # With the BLOCK policy nothing is read while the ring is full.
+        # Waits in slices of pollInterval to notice stop()
+        if self._ring._overflowPolicy != SerialRingBufferOverflowPolicy.BLOCK:
+            return True
+        if self._ring.remainingCapacity() > 0:
+            return True
+        return self._ring.wait_free(1, self._pollInterval)
+
+    def _waitReadable(self):
+        if self._fd is None:
+            return True
+        fds = [ self._fd ]
+        if self._wakeup is not None:
+            fds.append(self._wakeup[0])
+        readable, _, _ = select.select(fds, [ ], [ ], self._pollInterval)
+        return self._fd in readable
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                if not self._waitSpace():
+                    continue
+                if not self._waitReadable():
+                    continue
+                if self._stop.is_set():
+                    break
+
+                n = self._readOnce()
+                self.reads = self.reads + 1
+                if n > 0:
+                    self.bytesRead = self.bytesRead + n
+                elif self._fd is not None:
+                    # Readable without data means end of file
+                    self.eof = True
+                    break
+        except Exception as e:
+            self.error = e
+
+    def start(self):
+        if self._thread is not None:
+            raise ValueError("Reader thread is already running")
+
+        self._stop.clear()
+        self.error = None
+        self.eof = False
+        if self._fd is not None:
+            try:
+                self._wakeup = os.pipe()
+            except OSError:
+                self._wakeup = None
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+
+    def stop(self, timeout = None):
+        if self._thread is None:
+            return True
+
+        self._stop.set()
+        if self._wakeup is not None:
+            os.write(self._wakeup[1], b"\0")
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            return False
+
+        self._thread = None
+        if self._wakeup is not None:
+            os.close(self._wakeup[0])
+            os.close(self._wakeup[1])
+            self._wakeup = None
+        return True
+
+    def is_running(self):
+        return (self._thread is not None) and self._thread.is_alive()
@@ -2,19 +2,317 @@
 # lab device implementations.
 
 # This is a simple helper class
+#
+# The buffer supports two storage modes:
+#
+#   - The (default) element mode keeps one Python object per slot
+#     and is kept for compatibility with existing drivers
+#   - The binary mode is backed by a preallocated bytearray. push
+#     accepts bytes like objects and read returns bytes. Data is
+#     copied with at most two slice copies (one per contiguous
+#     region in case the data wraps around the end of the buffer).
+#     Single integers and lists of integers are still accepted
+#     by push and pop / peek return single integers.
+#
+# In binary mode readinto copies directly into a caller supplied
+# buffer and peek_view exposes the (up to two) contiguous regions of
+# buffered data as memoryviews without copying. Those views are only
+# valid until the data gets consumed by read, pop, discard or readinto.
+#
+# A producer can also let its data source write directly into the
+# ring: free_view returns (up to two) memoryviews over the free space
+# at head and commit publishes the number of bytes written there.
+#
+# Readers that have to wait for a reply can block on wait_available
+# or read_until instead of polling isAvailable / available. Both are
+# woken up by push via a condition variable sharing the buffer lock.
+# Producers can likewise wait for free space with wait_free.
+#
+# With spsc = True the buffer runs in single producer / single consumer
+# mode. The producer (push) only ever advances head and the consumer
+# (read, readinto, pop, discard, ...) only ever advances tail, each
+# index being written after the data has been copied. No lock is taken
+# in this mode; the producer only touches the condition variable in
+# case a consumer is currently waiting in wait_available or read_until.
+# Only one producer thread and one consumer thread may use the buffer.
+#
+# The overflowPolicy selects what push does when the data does not fit:
+#
+#   - DROP discards the pushed data (legacy behaviour)
+#   - RAISE discards the pushed data and raises CommunicationError_BufferOverflow
+#   - BLOCK waits up to overflowTimeout seconds (None: forever) for the
+#     consumer to free space and raises CommunicationError_BufferOverflow
+#     on timeout
+#   - OVERWRITE discards the oldest buffered data
+#   - GROW enlarges the storage (at least doubling it) up to maxBufferSize
+#     (which has to be larger than bufferSize) and drops the data in case
+#     it does not fit even then
+#
+# Dropped elements, overflow events and the high water mark are counted
+# and can be queried with statistics() for monitoring.
 
 import threading
+import time
 from collections import deque
+from enum import Enum
+
+from .exceptions import CommunicationError_BufferOverflow
+
+class SerialRingBufferOverflowPolicy(Enum):
+    DROP = 0
+    RAISE = 1
+    BLOCK = 2
+    OVERWRITE = 3
+    GROW = 4
+
+    @classmethod
+    def has_value(cls, v):
+        return v in cls._value2member_map_
+
+class _NoLock:
+    # Lock placeholder used in single producer / single consumer mode
+    def acquire(self, *ignore, **ignorekw):
+        return True
+    def release(self):
+        pass
+    def locked(self):
+        return False
+    def __enter__(self):
+        return self
+    def __exit__(self, *ignore):
+        return False
 
 class SerialRingBuffer:
-    def __init__(self, bufferSize = 512):
+    def __init__(
+        self,
+        bufferSize = 512,
+        binary = False,
+        spsc = False,
+
+        overflowPolicy = SerialRingBufferOverflowPolicy.DROP,
+        overflowTimeout = None,
+        maxBufferSize = None
+    ):
+        if not isinstance(bufferSize, int):
+            raise ValueError("Buffer size has to be an integer")
+        if bufferSize < 2:
+            raise ValueError("Buffer size has to be at least 2")
+        if not isinstance(binary, bool):
+            raise ValueError("Binary flag has to be boolean")
+        if not isinstance(spsc, bool):
+            raise ValueError("SPSC flag has to be boolean")
+        if not isinstance(overflowPolicy, SerialRingBufferOverflowPolicy):
+            raise ValueError(f"Overflow policy {overflowPolicy} is not a SerialRingBufferOverflowPolicy")
+        if spsc and (overflowPolicy in [ SerialRingBufferOverflowPolicy.OVERWRITE, SerialRingBufferOverflowPolicy.GROW ]):
+            raise ValueError(f"Overflow policy {overflowPolicy} is not supported in SPSC mode")
+        if (overflowTimeout is not None) and (not isinstance(overflowTimeout, (int, float)) or (overflowTimeout < 0)):
+            raise ValueError("Overflow timeout has to be a non negative number or None")
+        if maxBufferSize is None:
+            maxBufferSize = bufferSize
+        if not isinstance(maxBufferSize, int):
+            raise ValueError("Maximum buffer size has to be an integer")
+        if maxBufferSize < bufferSize:
+            raise ValueError("Maximum buffer size must not be smaller than the buffer size")
+        if (overflowPolicy == SerialRingBufferOverflowPolicy.GROW) and (maxBufferSize <= bufferSize):
+            raise ValueError("GROW overflow policy requires a maximum buffer size larger than the buffer size")
+
         self.bufferSize = bufferSize
-        self.buffer = [ ]
-        for i in range(512):
-            self.buffer.append(None)
+        self.binary = binary
+        if binary:
+            self.buffer = bytearray(bufferSize)
+            self._view = memoryview(self.buffer)
+        else:
+            self.buffer = [ None ] * bufferSize
+            self._view = None
         self.head = 0
         self.tail = 0
-        self.lock = threading.Lock()
+        self._spsc = spsc
+        self._waiters = 0
+        self._spaceWaiters = 0
+        if spsc:
+            # Separate locks per condition: the consumer notifies
+            # _spaceFreed while holding _dataPushed in read_until
+            self.lock = _NoLock()
+            self._dataPushed = threading.Condition(threading.Lock())
+            self._spaceFreed = threading.Condition(threading.Lock())
+        else:
+            self.lock = threading.Lock()
+            self._dataPushed = threading.Condition(self.lock)
+            self._spaceFreed = threading.Condition(self.lock)
+
+        self._overflowPolicy = overflowPolicy
+        self._overflowTimeout = overflowTimeout
+        self._maxBufferSize = maxBufferSize
+
+        self._dropped = 0
+        self._overflowEvents = 0
+        self._highWaterMark = 0
+
+    def _regions(self, start, length):
+        # Splits length elements starting at start into at most two
+        # contiguous regions (start, end) of the underlying storage
+        first = min(length, self.bufferSize - start)
+        if first == length:
+            return ( (start, start + length), )
+        return ( (start, start + first), (0, length - first) )
+
+    def _asBytes(self, data):
+        if isinstance(data, int):
+            return bytes(( data, ))
+        if isinstance(data, (list, tuple)):
+            return bytes(data)
+        return memoryview(data).cast("B")
+
+    def _store(self, data):
+        # Copies data into the free region at head. Capacity has
+        # to be checked by the caller
+        n = len(data)
+        if n == 0:
+            return
+        pos = 0
+        for (s, e) in self._regions(self.head, n):
+            if self.binary:
+                self._view[s:e] = data[pos:pos + (e - s)]
+            else:
+                self.buffer[s:e] = data[pos:pos + (e - s)]
+            pos = pos + (e - s)
+        self.head = (self.head + n) % self.bufferSize
+
+    def _load(self, length):
+        # Copies length elements from tail without consuming them
+        regions = self._regions(self.tail, length)
+        if self.binary:
+            if len(regions) == 1:
+                return bytes(self._view[regions[0][0]:regions[0][1]])
+            return b"".join([ self._view[s:e] for (s, e) in regions ])
+        res = [ ]
+        for (s, e) in regions:
+            res.extend(self.buffer[s:e])
+        return res
+
+    def _grow(self, required):
+        # Reallocates the storage so at least required elements fit,
+        # the buffered data is moved to the start of the new storage
+        newSize = min(max(2 * self.bufferSize, required + 1), self._maxBufferSize)
+        if newSize - 1 < required:
+            return False
+
+        avail = self.available(blocking = False)
+        if self.binary:
+            newBuffer = bytearray(newSize)
+            newBuffer[0:avail] = self._load(avail)
+            self.buffer = newBuffer
+            self._view = memoryview(newBuffer)
+        else:
+            self.buffer = self._load(avail) + ([ None ] * (newSize - avail))
+        self.bufferSize = newSize
+        self.tail = 0
+        self.head = avail
+        return True
+
+    def _makeRoom(self, n):
+        # Applies the overflow policy in case n elements do not fit.
+        # Returns the number of leading elements of the pushed data that
+        # have to be skipped or None in case the push has to be dropped
+        if self.remainingCapacity(blocking = False) >= n:
+            return 0
+        self._overflowEvents = self._overflowEvents + 1
+
+        if self._overflowPolicy == SerialRingBufferOverflowPolicy.OVERWRITE:
+            skip = max(0, n - (self.bufferSize - 1))
+            discard = min(n - skip - self.remainingCapacity(blocking = False), self.available(blocking = False))
+            self.tail = (self.tail + discard) % self.bufferSize
+            self._dropped = self._dropped + discard + skip
+            return skip
+
+        if self._overflowPolicy == SerialRingBufferOverflowPolicy.GROW:
+            if self._grow(self.available(blocking = False) + n):
+                return 0
+        elif (self._overflowPolicy == SerialRingBufferOverflowPolicy.BLOCK) and (n <= self.bufferSize - 1):
+            if self._waitSpace(n):
+                return 0
+
+        self._dropped = self._dropped + n
+        if self._overflowPolicy in [ SerialRingBufferOverflowPolicy.RAISE, SerialRingBufferOverflowPolicy.BLOCK ]:
+            raise CommunicationError_BufferOverflow(f"Ringbuffer overflow, dropped {n} elements")
+        return None
+
+    def _waitSpace(self, n):
+        if self._spsc:
+            with self._spaceFreed:
+                self._spaceWaiters = self._spaceWaiters + 1
+                try:
+                    return self._spaceFreed.wait_for(lambda: self.remainingCapacity(blocking = False) >= n, self._overflowTimeout)
+                finally:
+                    self._spaceWaiters = self._spaceWaiters - 1
+
+        # In locked mode the caller holds the lock shared with the condition
+        self._spaceWaiters = self._spaceWaiters + 1
+        try:
+            return self._spaceFreed.wait_for(lambda: self.remainingCapacity(blocking = False) >= n, self._overflowTimeout)
+        finally:
+            self._spaceWaiters = self._spaceWaiters - 1
+
+    def _find(self, delimiter, start = 0):
+        # Returns the offset (relative to tail) of the first occurrence
+        # of delimiter at or after start or -1. Lock has to be held
+        avail = self.available(blocking = False)
+        dlen = len(delimiter)
+        if (dlen == 0) or (avail - start < dlen):
+            return -1
+
+        if not self.binary:
+            for i in range(start, avail - dlen + 1):
+                for j in range(dlen):
+                    if self.buffer[(self.tail + i + j) % self.bufferSize] != delimiter[j]:
+                        break
+                else:
+                    return i
+            return -1
+
+        regions = self._regions(self.tail, avail)
+        s, e = regions[0]
+        firstLen = e - s
+        if start < firstLen:
+            idx = self.buffer.find(delimiter, s + start, e)
+            if idx >= 0:
+                return idx - s
+        if len(regions) == 1:
+            return -1
+
+        # Delimiter straddling the end of the storage
+        s2, e2 = regions[1]
+        if dlen > 1:
+            wstart = max(start, firstLen - dlen + 1)
+            if wstart < firstLen:
+                window = bytes(self._view[s + wstart:e]) + bytes(self._view[0:min(dlen - 1, e2)])
+                idx = window.find(delimiter)
+                if idx >= 0:
+                    return wstart + idx
+
+        idx = self.buffer.find(delimiter, max(0, start - firstLen), e2)
+        if idx >= 0:
+            return firstLen + idx
+        return -1
+
+    def _notifyPushed(self):
+        # head has already been advanced, a consumer that registered
+        # itself as waiter before will either see the data or wait. In
+        # locked mode the caller always holds the lock
+        if self._waiters > 0:
+            if self._spsc:
+                with self._dataPushed:
+                    self._dataPushed.notify_all()
+            else:
+                self._dataPushed.notify_all()
+
+    def _notifyConsumed(self):
+        if self._spaceWaiters > 0:
+            if self._spsc:
+                with self._spaceFreed:
+                    self._spaceFreed.notify_all()
+            else:
+                self._spaceFreed.notify_all()
 
     def isAvailable(self, *ignore, blocking = True):
         if blocking:
@@ -31,11 +329,15 @@ class SerialRingBuffer:
     def available(self, *ignore, blocking = True):
         if blocking:
             self.lock.acquire()
+        # Snapshot both indices, in SPSC mode the other side may
+        # advance its index concurrently
+        head = self.head
+        tail = self.tail
         res = 0
-        if self.head >= self.tail:
-            res = self.head - self.tail;
+        if head >= tail:
+            res = head - tail;
         else:
-            res = self.bufferSize - self.tail + self.head
+            res = self.bufferSize - tail + head
         if blocking:
             self.lock.release()
         return res
@@ -48,6 +350,7 @@ class SerialRingBuffer:
             self.tail = (self.tail + avail) % self.bufferSize
         else:
             self.tail = (self.tail + len) % self.bufferSize
+        self._notifyConsumed()
         if blocking:
             self.lock.release()
         return None
@@ -76,27 +379,47 @@ class SerialRingBuffer:
     def capacity(self, *ignore, blocking = True):
         return self.bufferSize
 
+    def statistics(self, *ignore, blocking = True):
+        if blocking:
+            self.lock.acquire()
+        res = {
+            'capacity' : self.bufferSize,
+            'available' : self.available(blocking = False),
+            'dropped' : self._dropped,
+            'overflowEvents' : self._overflowEvents,
+            'highWaterMark' : self._highWaterMark
+        }
+        if blocking:
+            self.lock.release()
+        return res
+
+    def resetStatistics(self, *ignore, blocking = True):
+        if blocking:
+            self.lock.acquire()
+        self._dropped = 0
+        self._overflowEvents = 0
+        self._highWaterMark = self.available(blocking = False)
+        if blocking:
+            self.lock.release()
+
     def push(self, data, *ignore, blocking = True):
+        if self.binary:
+            data = self._asBytes(data)
+        elif not isinstance(data, list):
+            data = [ data ]
+
         if blocking:
             self.lock.acquire()
-        if isinstance(data, list):
-            if self.remainingCapacity(blocking = False) <  len(data):
-                # Raise error ... ToDo
-                if blocking:
-                    self.lock.release()
-                return
-            else:
-                for c in data:
-                    self.push(c, blocking = False)
-        else:
-            if self.remainingCapacity(blocking = False) < 1:
-                # Raise error ... ToDo
-                if blocking:
-                    self.lock.release()
+        try:
+            skip = self._makeRoom(len(data))
+            if skip is None:
                 return
-            self.buffer[self.head] = data
-            self.head = (self.head + 1) % self.bufferSize
-        self.lock.release()
+            self._store(data[skip:] if skip > 0 else data)
+            self._highWaterMark = max(self._highWaterMark, self.available(blocking = False))
+            self._notifyPushed()
+        finally:
+            if blocking:
+                self.lock.release()
 
     def pop(self, *ignore, blocking = True):
         if blocking:
@@ -105,6 +428,7 @@ class SerialRingBuffer:
         if self.head != self.tail:
             ret = self.buffer[self.tail]
             self.tail = (self.tail + 1) % self.bufferSize
+            self._notifyConsumed()
         if blocking:
             self.lock.release()
         return ret
@@ -117,10 +441,143 @@ class SerialRingBuffer:
             if blocking:
                 self.lock.release()
             return None
-        ret = [ ]
-        for i in range(len):
-            ret.append(self.buffer[(self.tail + i) % self.bufferSize])
+        ret = self._load(len)
         self.tail = (self.tail + len) % self.bufferSize
+        self._notifyConsumed()
         if blocking:
             self.lock.release()
         return ret
+
+    def wait_available(self, n = 1, timeout = None):
+        if not isinstance(n, int):
+            raise ValueError("Number of elements has to be an integer")
+        maxElements = self.bufferSize - 1
+        if self._overflowPolicy == SerialRingBufferOverflowPolicy.GROW:
+            maxElements = self._maxBufferSize - 1
+        if (n < 1) or (n > maxElements):
+            raise ValueError(f"Number of elements {n} is out of range 1 to {maxElements}")
+
+        with self._dataPushed:
+            self._waiters = self._waiters + 1
+            try:
+                return self._dataPushed.wait_for(lambda: self.available(blocking = False) >= n, timeout)
+            finally:
+                self._waiters = self._waiters - 1
+
+    def wait_free(self, n = 1, timeout = None):
+        # Waits until n elements can be pushed without overflow
+        if not isinstance(n, int):
+            raise ValueError("Number of elements has to be an integer")
+        if (n < 1) or (n > self.bufferSize - 1):
+            raise ValueError(f"Number of elements {n} is out of range 1 to {self.bufferSize - 1}")
+
+        with self._spaceFreed:
+            self._spaceWaiters = self._spaceWaiters + 1
+            try:
+                return self._spaceFreed.wait_for(lambda: self.remainingCapacity(blocking = False) >= n, timeout)
+            finally:
+                self._spaceWaiters = self._spaceWaiters - 1
+
+    def read_until(self, delimiter, timeout = None):
+        if self.binary:
+            delimiter = bytes(self._asBytes(delimiter))
+        elif not isinstance(delimiter, list):
+            delimiter = [ delimiter ]
+        if len(delimiter) == 0:
+            raise ValueError("Delimiter must not be empty")
+
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+
+        # Already scanned data is not searched again after wakeup
+        searched = 0
+        with self._dataPushed:
+            self._waiters = self._waiters + 1
+            try:
+                while True:
+                    avail = self.available(blocking = False)
+                    idx = self._find(delimiter, searched)
+                    if idx >= 0:
+                        return self.read(idx + len(delimiter), blocking = False)
+                    searched = max(0, avail - len(delimiter) + 1)
+
+                    if deadline is None:
+                        self._dataPushed.wait()
+                    else:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            return None
+                        self._dataPushed.wait(remaining)
+            finally:
+                self._waiters = self._waiters - 1
+
+    def readinto(self, buffer, *ignore, blocking = True):
+        if not self.binary:
+            raise TypeError("readinto is only supported in binary mode")
+        target = memoryview(buffer).cast("B")
+
+        if blocking:
+            self.lock.acquire()
+        n = min(len(target), self.available(blocking = False))
+        pos = 0
+        for (s, e) in self._regions(self.tail, n):
+            target[pos:pos + (e - s)] = self._view[s:e]
+            pos = pos + (e - s)
+        self.tail = (self.tail + n) % self.bufferSize
+        self._notifyConsumed()
+        if blocking:
+            self.lock.release()
+        return n
+
+    def peek_view(self, n = None, *ignore, blocking = True):
+        if not self.binary:
+            raise TypeError("peek_view is only supported in binary mode")
+
+        if blocking:
+            self.lock.acquire()
+        avail = self.available(blocking = False)
+        if (n is None) or (n > avail):
+            n = avail
+        if n <= 0:
+            res = ( )
+        else:
+            res = tuple([ self._view[s:e] for (s, e) in self._regions(self.tail, n) ])
+        if blocking:
+            self.lock.release()
+        return res
+
+    def free_view(self, n = None, *ignore, blocking = True):
+        if not self.binary:
+            raise TypeError("free_view is only supported in binary mode")
+
+        if blocking:
+            self.lock.acquire()
+        free = self.remainingCapacity(blocking = False)
+        if (n is None) or (n > free):
+            n = free
+        if n <= 0:
+            res = ( )
+        else:
+            res = tuple([ self._view[s:e] for (s, e) in self._regions(self.head, n) ])
+        if blocking:
+            self.lock.release()
+        return res
+
+    def commit(self, n, *ignore, blocking = True):
+        if not self.binary:
+            raise TypeError("commit is only supported in binary mode")
+        if not isinstance(n, int) or (n < 0):
+            raise ValueError("Number of committed bytes has to be a non negative integer")
+
+        if blocking:
+            self.lock.acquire()
+        try:
+            if n > self.remainingCapacity(blocking = False):
+                raise ValueError(f"Cannot commit {n} bytes, only {self.remainingCapacity(blocking = False)} bytes free")
+            self.head = (self.head + n) % self.bufferSize
+            self._highWaterMark = max(self._highWaterMark, self.available(blocking = False))
+            self._notifyPushed()
+        finally:
+            if blocking:
+                self.lock.release()
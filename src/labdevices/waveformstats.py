@@ -0,0 +1,110 @@
+import numpy as np
+
+# Vectorized waveform statistics
+#
+# All functions operate on 2D arrays of shape (channels, points) and
+# process every channel in a single NumPy call. computeStatistics only
+# calculates the requested outputs and shares intermediate results
+# (e.g. minimum and maximum for the peak to peak value).
+#
+# Correlations are calculated via zero padded FFTs in O(N log N). The
+# results match np.correlate(a, v, mode = "full") up to floating point
+# rounding; integer inputs are rounded back to integers.
+
+defaultPercentiles = ( 5, 25, 50, 75, 95 )
+
+scalarStatistics = ( "mean", "std", "rms", "min", "max", "ptp", "percentiles" )
+
+def _asRows(y):
+    y = np.asarray(y)
+    if y.ndim == 1:
+        return y.reshape(( 1, len(y) ))
+    if y.ndim != 2:
+        raise ValueError("Waveform data has to be a 1D or 2D array")
+    return y
+
+def _fftLength(n):
+    return 1 << (n - 1).bit_length()
+
+def computeStatistics(y, stats, percentiles = defaultPercentiles):
+    # Returns a dictionary with one array (one entry per channel) for
+    # every requested statistic out of scalarStatistics. Percentiles
+    # are returned as (channels, len(percentiles)) array
+    y = _asRows(y)
+    for stat in stats:
+        if stat not in scalarStatistics:
+            raise ValueError(f"Unknown statistic {stat}")
+
+    res = { }
+    if ("mean" in stats) or ("std" in stats):
+        mean = np.mean(y, axis = 1)
+        if "mean" in stats:
+            res["mean"] = mean
+        if "std" in stats:
+            res["std"] = np.sqrt(np.mean(np.abs(y - mean[:, None])**2, axis = 1))
+    if "rms" in stats:
+        res["rms"] = np.sqrt(np.mean(np.abs(y)**2, axis = 1))
+    if ("min" in stats) or ("ptp" in stats):
+        res["min"] = np.min(y, axis = 1)
+    if ("max" in stats) or ("ptp" in stats):
+        res["max"] = np.max(y, axis = 1)
+    if "ptp" in stats:
+        res["ptp"] = res["max"] - res["min"]
+        if "min" not in stats:
+            del res["min"]
+        if "max" not in stats:
+            del res["max"]
+    if "percentiles" in stats:
+        res["percentiles"] = np.percentile(y, percentiles, axis = 1).T
+    return res
+
+def rfftSpectrum(y, sampleInterval = None):
+    # Returns (frequencies, spectrum) of the real valued waveforms. The
+    # frequency axis is in Hz if the sample interval is known and in
+    # cycles per sample otherwise
+    y = _asRows(y)
+    spectrum = np.fft.rfft(y, axis = 1)
+    frequencies = np.fft.rfftfreq(y.shape[1], d = 1.0 if sampleInterval is None else sampleInterval)
+    return frequencies, spectrum
+
+def _correlationSpectra(y, fftLength):
+    # np.correlate(a, v, "full") equals np.convolve(a, conj(v[::-1])) so
+    # the spectra of the rows and of the conjugated reversed rows are
+    # required
+    if np.iscomplexobj(y):
+        return np.fft.fft(y, fftLength, axis = 1), np.fft.fft(np.conj(y[:, ::-1]), fftLength, axis = 1)
+    return np.fft.rfft(y, fftLength, axis = 1), np.fft.rfft(y[:, ::-1], fftLength, axis = 1)
+
+def _correlationResult(product, y, fftLength):
+    nOut = 2 * y.shape[1] - 1
+    if np.iscomplexobj(y):
+        res = np.fft.ifft(product, fftLength, axis = 1)[:, 0:nOut]
+    else:
+        res = np.fft.irfft(product, fftLength, axis = 1)[:, 0:nOut]
+    if np.issubdtype(y.dtype, np.integer):
+        res = np.rint(res).astype(np.result_type(y.dtype, np.int64))
+    return res
+
+def autocorrelate(y):
+    # Full autocorrelation of every row, shape (channels, 2*points-1)
+    y = _asRows(y)
+    fftLength = _fftLength(2 * y.shape[1] - 1)
+    spectrum, reversedSpectrum = _correlationSpectra(y, fftLength)
+    return _correlationResult(spectrum * reversedSpectrum, y, fftLength)
+
+def correlatePairs(y, pairs = None):
+    # Full cross correlation np.correlate(y[i], y[j], "full") for every
+    # (i, j) in pairs (by default all i < j). Returns an array of shape
+    # (len(pairs), 2*points-1) and the list of pairs
+    y = _asRows(y)
+    if pairs is None:
+        pairs = [ ( i, j ) for i in range(y.shape[0] - 1) for j in range(i + 1, y.shape[0]) ]
+    pairs = [ ( int(i), int(j) ) for i, j in pairs ]
+    if len(pairs) == 0:
+        return np.empty(( 0, 2 * y.shape[1] - 1 )), pairs
+
+    fftLength = _fftLength(2 * y.shape[1] - 1)
+    spectrum, reversedSpectrum = _correlationSpectra(y, fftLength)
+    first = np.array([ p[0] for p in pairs ])
+    second = np.array([ p[1] for p in pairs ])
+    return _correlationResult(spectrum[first] * reversedSpectrum[second], y, fftLength), pairs
@@ -0,0 +1,140 @@
+# Stress test for the lock free single producer / single consumer mode
+# of SerialRingBuffer
+#
+# A producer and a consumer thread transfer a deterministic byte
+# sequence through a small ring (so the indices wrap around very often)
+# using varying chunk sizes. The received data has to match exactly.
+# Every test also fails in case one of the threads does not finish,
+# which catches lost wakeups and deadlocks.
+#
+# Runs with pytest or directly as script:
+#
+#   python tests/test_serialringbuffer_spsc.py [bytes]
+
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from labdevices.serialringbuffer import SerialRingBuffer, SerialRingBufferOverflowPolicy
+
+TRANSFER = 200000
+JOIN_TIMEOUT = 60
+
+def _pattern(n):
+    return bytes([ i & 0xFF for i in range(n) ])
+
+def _run(producer, consumer):
+    errors = [ ]
+    def wrap(fn):
+        def run():
+            try:
+                fn()
+            except Exception as e:
+                errors.append(e)
+        return run
+
+    threads = [ threading.Thread(target = wrap(producer), daemon = True), threading.Thread(target = wrap(consumer), daemon = True) ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(JOIN_TIMEOUT)
+    assert not any([ t.is_alive() for t in threads ]), "Producer or consumer did not finish (deadlock or lost wakeup)"
+    assert len(errors) == 0, f"Thread failed: {errors}"
+
+def test_spsc_drop_read_readinto(transfer = TRANSFER):
+    # Producer only pushes what fits, consumer alternates between
+    # wait_available / read and readinto
+    ring = SerialRingBuffer(257, binary = True, spsc = True)
+    data = _pattern(transfer)
+    received = bytearray()
+
+    def producer():
+        pos = 0
+        while pos < transfer:
+            chunk = data[pos:pos + (pos % 13) + 1]
+            if ring.remainingCapacity() >= len(chunk):
+                ring.push(chunk)
+                pos = pos + len(chunk)
+
+    def consumer():
+        buf = bytearray(50)
+        while len(received) < transfer:
+            if len(received) % 3 == 0:
+                if ring.wait_available(1, 1):
+                    received.extend(ring.read(1))
+            else:
+                n = ring.readinto(buf)
+                received.extend(buf[0:n])
+
+    _run(producer, consumer)
+    assert bytes(received) == data
+    assert ring.statistics()['dropped'] == 0
+
+def test_spsc_block_read_until(transfer = TRANSFER):
+    # Producer pushes newline terminated frames with BLOCK policy, the
+    # consumer reads them with read_until (which consumes while holding
+    # the data condition and has to wake the blocked producer)
+    ring = SerialRingBuffer(16, binary = True, spsc = True, overflowPolicy = SerialRingBufferOverflowPolicy.BLOCK, overflowTimeout = 10)
+    frames = [ (b"%d:" % i) + b"x" * (i % 7) + b"\n" for i in range(transfer // 8) ]
+    received = [ ]
+
+    def producer():
+        for frame in frames:
+            ring.push(frame)
+
+    def consumer():
+        while len(received) < len(frames):
+            frame = ring.read_until(b"\n", timeout = 10)
+            assert frame is not None, "read_until timed out"
+            received.append(frame)
+
+    _run(producer, consumer)
+    assert received == frames
+
+def test_spsc_block_commit_readinto(transfer = TRANSFER):
+    # Producer writes through free_view / commit and blocking pushes,
+    # consumer drains with readinto and discard
+    ring = SerialRingBuffer(64, binary = True, spsc = True, overflowPolicy = SerialRingBufferOverflowPolicy.BLOCK, overflowTimeout = 10)
+    data = _pattern(transfer)
+    received = bytearray()
+
+    def producer():
+        pos = 0
+        while pos < transfer:
+            n = min((pos % 31) + 1, transfer - pos)
+            if (pos // 7) % 2 == 0:
+                ring.push(data[pos:pos + n])
+            else:
+                views = ring.free_view(n)
+                n = 0
+                for view in views:
+                    view[:] = data[pos + n:pos + n + len(view)]
+                    n = n + len(view)
+                ring.commit(n)
+            pos = pos + n
+
+    def consumer():
+        buf = bytearray(23)
+        while len(received) < transfer:
+            if not ring.wait_available(1, 10):
+                raise RuntimeError("wait_available timed out")
+            views = ring.peek_view(5)
+            if (len(received) % 5 == 0) and (len(views) > 0):
+                chunk = b"".join([ bytes(v) for v in views ])
+                ring.discard(len(chunk))
+                received.extend(chunk)
+            else:
+                n = ring.readinto(buf)
+                received.extend(buf[0:n])
+
+    _run(producer, consumer)
+    assert bytes(received) == data
+    assert ring.statistics()['dropped'] == 0
+
+if __name__ == "__main__":
+    transfer = int(sys.argv[1]) if len(sys.argv) > 1 else TRANSFER
+    for test in [ test_spsc_drop_read_readinto, test_spsc_block_read_until, test_spsc_block_commit_readinto ]:
+        test(transfer)
+        print(f"{test.__name__}: ok ({transfer} bytes)")